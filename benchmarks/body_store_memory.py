@@ -0,0 +1,98 @@
+"""Redis memory per 100k queued jobs: inline bodies vs body store references.
+
+    python benchmarks/body_store_memory.py --redis redis://localhost:6379/15 \\
+        --jobs 100000 --body-bytes 20000 --distinct-bodies 1
+
+The database is flushed before each mode. ``used_memory`` deltas are exact;
+the allocator rarely hands memory back after FLUSHDB, so for meaningful RSS
+numbers run each mode against a freshly started Redis (``--modes inline``,
+then ``--modes ref``).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import redis  # noqa: E402
+from common.body_store import RedisBodyStore, body_ref  # noqa: E402
+
+
+def memory(r):
+    info = r.info("memory")
+    return info["used_memory"], info.get("used_memory_rss", 0)
+
+
+def make_body(i, size):
+    text = f"<html><body><h1>Campaign {i}</h1>" + "<p>Lorem ipsum dolor sit amet.</p>" * (size // 34 + 1)
+    return text[:size]
+
+
+def run_mode(mode, r, args):
+    r.flushdb()
+    time.sleep(0.5)
+    used_before, rss_before = memory(r)
+    store = RedisBodyStore(r, args.ttl)
+    bodies = [make_body(i, args.body_bytes) for i in range(args.distinct_bodies)]
+    refs = [store.put(body) if mode == "ref" else body_ref(body) for body in bodies]
+    copies = args.copies.split(",")
+
+    pipe = r.pipeline(transaction=False)
+    for i in range(args.jobs):
+        job = {
+            "from": "news@yourdomain.com",
+            "to": f"user{i}@example.com",
+            "subject": "Monthly newsletter",
+            "priority": "bulk",
+            "job_id": f"00000000-0000-0000-0000-{i:012d}",
+            "submitted_at": time.time(),
+            "client_ip": "10.0.0.1",
+        }
+        if mode == "ref":
+            job["body_ref"] = refs[i % len(refs)]
+        else:
+            job["body"] = bodies[i % len(bodies)]
+        payload = json.dumps(job)
+        for queue in copies:
+            pipe.rpush(queue, payload)
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+    time.sleep(0.5)
+    used_after, rss_after = memory(r)
+    scale = 100000 / args.jobs
+    return {
+        "mode": mode,
+        "jobs": args.jobs,
+        "copies_per_job": len(copies),
+        "used_memory_mb_per_100k": round((used_after - used_before) * scale / 2 ** 20, 2),
+        "rss_mb_per_100k": round((rss_after - rss_before) * scale / 2 ** 20, 2),
+        "bytes_per_job": round((used_after - used_before) / args.jobs, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis", default="redis://localhost:6379/15", help="Redis URL; the database is flushed")
+    parser.add_argument("--jobs", type=int, default=100000)
+    parser.add_argument("--body-bytes", type=int, default=20000)
+    parser.add_argument("--distinct-bodies", type=int, default=1, help="Distinct bodies in the campaign")
+    parser.add_argument("--copies", default="email_jobs:bulk",
+                        help="Lists each job is pushed to, e.g. email_jobs:bulk,delivered to include retained copies")
+    parser.add_argument("--ttl", type=int, default=7 * 86400)
+    parser.add_argument("--modes", default="inline,ref")
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(args.redis, decode_responses=True)
+    try:
+        results = [run_mode(mode, r, args) for mode in args.modes.split(",")]
+    finally:
+        r.flushdb()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
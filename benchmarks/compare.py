@@ -0,0 +1,70 @@
+"""Compare two load_test.py result files and flag regressions.
+
+    python benchmarks/compare.py baseline.json candidate.json --tolerance 0.10
+
+Exits with status 1 when throughput drops, or any p95 latency rises, by more
+than the tolerance.
+"""
+import argparse
+import json
+import sys
+
+
+def p95_by_series(results):
+    series = {}
+    for metric, entries in results.get("latency", {}).items():
+        for entry in entries:
+            labels = ",".join(f"{k}={v}" for k, v in sorted(entry["labels"].items()))
+            series[f"{metric}{{{labels}}}"] = entry.get("p95_s")
+    return series
+
+
+def change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) / old
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative change (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"baseline  {baseline['meta'].get('git_revision')}  {baseline['meta']['timestamp']}")
+    print(f"candidate {candidate['meta'].get('git_revision')}  {candidate['meta']['timestamp']}")
+
+    old_tp = baseline["summary"].get("throughput_per_s")
+    new_tp = candidate["summary"].get("throughput_per_s")
+    delta = change(old_tp, new_tp)
+    print(f"\nthroughput_per_s  {old_tp} -> {new_tp}" + (f"  ({delta:+.1%})" if delta is not None else ""))
+    if delta is not None and delta < -args.tolerance:
+        regressions.append("throughput_per_s")
+
+    old_p95 = p95_by_series(baseline)
+    new_p95 = p95_by_series(candidate)
+    print("\np95 latency (s)")
+    for series in sorted(set(old_p95) | set(new_p95)):
+        old, new = old_p95.get(series), new_p95.get(series)
+        delta = change(old, new)
+        print(f"  {series}  {old} -> {new}" + (f"  ({delta:+.1%})" if delta is not None else ""))
+        if delta is not None and delta > args.tolerance:
+            regressions.append(series)
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for name in regressions:
+            print(f"  {name}")
+        sys.exit(1)
+    print("\nNo regressions beyond tolerance")
+
+
+if __name__ == "__main__":
+    main()
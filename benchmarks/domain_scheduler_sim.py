@@ -0,0 +1,183 @@
+"""Simulate delivery with one deferring receiver: FIFO worker vs per-domain scheduler.
+
+Needs a local Redis (the given database is flushed) and the worker requirements:
+
+    python benchmarks/domain_scheduler_sim.py --redis redis://localhost:6379/15
+
+A local SMTP sink answers 451 for the deferred domains after a tarpit delay.
+In ``fifo`` mode workers pop ``email_jobs`` in order and every deferred job is
+pushed straight back to the tail, as it is once the retry-handler requeues it.
+In ``domain`` mode workers go through ``DomainScheduler``. The report compares
+how long mail to healthy domains waits and how many attempts were wasted on
+the deferring domain.
+"""
+import argparse
+import json
+import os
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "worker"))
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="sim_logs_"))
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import redis  # noqa: E402
+import worker  # noqa: E402
+from scheduler import DomainScheduler, recipient_domain  # noqa: E402
+from smtp_sink import SmtpSink  # noqa: E402
+
+
+def make_jobs(count, deferred_share, deferred_domains, healthy_domains):
+    jobs = []
+    step = int(1 / deferred_share) if deferred_share else 0
+    for i in range(count):
+        if step and i % step == 0:
+            domain = deferred_domains[i % len(deferred_domains)]
+        else:
+            domain = healthy_domains[i % len(healthy_domains)]
+        jobs.append({
+            "job_id": f"sim-{i}",
+            "from": "sim@yourdomain.com",
+            "to": f"user{i}@{domain}",
+            "subject": "Simulation",
+            "body": "Hello from the domain scheduler simulation.",
+            "submitted_at": time.time(),
+        })
+    return jobs
+
+
+def attempt(data, smtp_conf):
+    """Return True when delivered, False when deferred."""
+    try:
+        worker.send_email(data, smtp_conf, worker.build_message(data, data["body"]))
+        return True
+    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+        if 400 <= worker.smtp_error_code(e) < 500:
+            return False
+        raise
+
+
+def run_mode(mode, r, args, smtp_conf, deferred_domains):
+    r.flushdb()
+    jobs = make_jobs(args.jobs, args.deferred_share, deferred_domains, args.healthy_domains)
+    healthy_total = sum(1 for j in jobs if recipient_domain(j) not in deferred_domains)
+    r.rpush("email_jobs", *[json.dumps(j) for j in jobs])
+    start = time.time()
+    stats = {"latencies": [], "deferred_attempts": 0, "delivered": 0}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    scheduler = DomainScheduler(
+        r,
+        {"default": {"concurrency": args.concurrency, "rate_per_sec": args.rate}},
+        lanes=["normal"],
+        backoff_base=args.backoff_base,
+        backoff_max=args.backoff_max,
+    )
+
+    def record(data, delivered):
+        with lock:
+            if not delivered:
+                stats["deferred_attempts"] += 1
+                return
+            stats["delivered"] += 1
+            if recipient_domain(data) not in deferred_domains:
+                stats["latencies"].append(time.time() - start)
+                if len(stats["latencies"]) >= healthy_total:
+                    done.set()
+
+    def fifo_loop():
+        while not done.is_set():
+            job = r.blpop("email_jobs", timeout=1)
+            if not job:
+                continue
+            data = json.loads(job[1])
+            delivered = attempt(data, smtp_conf)
+            if not delivered:
+                r.rpush("email_jobs", job[1])
+            record(data, delivered)
+
+    def domain_loop():
+        while not done.is_set():
+            scheduler.ingest_from("email_jobs", "normal", 100)
+            picked = scheduler.next_job("normal")
+            if not picked:
+                time.sleep(min(0.05, scheduler.seconds_until_ready(0.05)))
+                continue
+            domain, raw = picked
+            try:
+                data = json.loads(raw)
+                delivered = attempt(data, smtp_conf)
+                if delivered:
+                    scheduler.record_success(domain)
+                else:
+                    scheduler.defer(domain, raw, "normal")
+                record(data, delivered)
+            finally:
+                scheduler.release(domain)
+
+    threads = [threading.Thread(target=fifo_loop if mode == "fifo" else domain_loop, daemon=True)
+               for _ in range(args.workers)]
+    for t in threads:
+        t.start()
+    finished = done.wait(args.timeout)
+    done.set()
+    for t in threads:
+        t.join(5)
+
+    latencies = sorted(stats["latencies"])
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3) if latencies else None
+
+    return {
+        "mode": mode,
+        "completed": finished,
+        "elapsed_s": round(time.time() - start, 3),
+        "healthy_jobs": healthy_total,
+        "healthy_delivered": len(latencies),
+        "healthy_p50_s": pct(0.50),
+        "healthy_p95_s": pct(0.95),
+        "healthy_max_s": round(latencies[-1], 3) if latencies else None,
+        "deferred_attempts": stats["deferred_attempts"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis", default="redis://localhost:6379/15")
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--deferred-share", type=float, default=0.3)
+    parser.add_argument("--deferred-domains", default="bigmail.example")
+    parser.add_argument("--healthy-domains", default="a.example,b.example,c.example")
+    parser.add_argument("--defer-delay", type=float, default=0.05, help="Sink tarpit before a 451")
+    parser.add_argument("--latency", type=float, default=0.0, help="Sink latency per accepted message")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=int, default=1000)
+    parser.add_argument("--backoff-base", type=float, default=2)
+    parser.add_argument("--backoff-max", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--modes", default="fifo,domain")
+    args = parser.parse_args()
+    args.healthy_domains = args.healthy_domains.split(",")
+    deferred_domains = args.deferred_domains.split(",")
+
+    sink = SmtpSink(defer_domains=deferred_domains, defer_delay=args.defer_delay, latency=args.latency).start()
+    smtp_conf = {"id": "sink", "host": sink.host, "port": sink.port}
+    r = redis.Redis.from_url(args.redis, decode_responses=True)
+    try:
+        results = [run_mode(mode, r, args, smtp_conf, deferred_domains) for mode in args.modes.split(",")]
+    finally:
+        r.flushdb()
+        sink.stop()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Job codec throughput and size: legacy JSON vs msgpack vs msgpack+zstd.
+
+    python benchmarks/job_codec_bench.py --seconds 1 --zstd-min-bytes 4096
+
+CPU only, no Redis needed. For every job shape it reports encode and decode
+ops/sec and the bytes each job occupies in a queue. JSON decode is measured
+on str payloads, as the services received them from a decode_responses
+client before the codec.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import job_codec  # noqa: E402
+from common.job_codec import decode_job, encode_job  # noqa: E402
+
+
+def make_job(body_bytes=None, recipients=1):
+    job = {
+        "from": "news@yourdomain.com",
+        "to": "user0@example.com" if recipients == 1 else [f"user{i}@example.com" for i in range(recipients)],
+        "subject": "Monthly newsletter",
+        "priority": "bulk",
+        "job_id": "00000000-0000-0000-0000-000000000000",
+        "submitted_at": time.time(),
+        "client_ip": "10.0.0.1",
+        "retries": 0,
+    }
+    if body_bytes is None:
+        job["body_ref"] = "sha256:" + "ab" * 32
+    else:
+        text = "<html><body><h1>Campaign</h1>" + "<p>Lorem ipsum dolor sit amet.</p>" * (body_bytes // 34 + 1)
+        job["body"] = text[:body_bytes]
+    return job
+
+
+SHAPES = {
+    "body_ref": make_job(),
+    "inline_1k": make_job(1000),
+    "inline_20k": make_job(20000),
+    "ref_50_recipients": make_job(recipients=50),
+}
+
+
+def rate(fn, arg, seconds):
+    """Calls per second of fn(arg), measured over roughly `seconds`."""
+    n, batch = 0, 100
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            fn(arg)
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+def run_codec(codec, job, args):
+    if codec == "json":
+        encode = json.dumps
+        decode = json.loads
+    else:
+        job_codec.ZSTD_MIN_BYTES = args.zstd_min_bytes if codec == "msgpack+zstd" else float("inf")
+        encode = lambda data: encode_job(data, "msgpack")  # noqa: E731
+        decode = decode_job
+    payload = encode(job)
+    assert decode(payload) == job
+    size = len(payload.encode() if isinstance(payload, str) else payload)
+    return {
+        "codec": codec,
+        "bytes_per_job": size,
+        "encode_ops_per_s": round(rate(encode, job, args.seconds)),
+        "decode_ops_per_s": round(rate(decode, payload, args.seconds)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=1.0, help="Measuring time per codec, shape and direction")
+    parser.add_argument("--zstd-min-bytes", type=int, default=job_codec.ZSTD_MIN_BYTES)
+    parser.add_argument("--codecs", default="json,msgpack,msgpack+zstd")
+    parser.add_argument("--shapes", default=",".join(SHAPES))
+    args = parser.parse_args()
+
+    if job_codec.msgpack is None:
+        sys.exit("msgpack is not installed")
+    results = {}
+    for shape in args.shapes.split(","):
+        rows = [run_codec(codec, SHAPES[shape], args) for codec in args.codecs.split(",")]
+        base = rows[0]["bytes_per_job"]
+        for row in rows:
+            row["size_vs_" + rows[0]["codec"]] = round(row["bytes_per_job"] / base, 3)
+        results[shape] = rows
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""End-to-end load test of the mail pipeline against a local SMTP sink.
+
+Starts the gateway, unsubscribe-processor, worker(s) and retry-handler as
+local processes wired to one Redis database (which is flushed), submits a
+generated or replayed job mix through POST /send, and writes throughput,
+per-stage latency percentiles and queue depths over time as JSON:
+
+    python benchmarks/load_test.py --redis redis://localhost:6379/15 \\
+        --jobs 5000 --rate 200 --workers 2 --sink-latency 0.01 \\
+        --sink-defer-rate 0.02 --sink-reject-rate 0.01 --output results.json
+
+The services run chained as gateway -> email_jobs -> unsubscribe-processor ->
+filtered_jobs -> worker, with the retry-handler feeding failed_jobs back into
+email_jobs. This differs from docker-compose.yml, where the worker and the
+unsubscribe-processor both consume email_jobs: there, jobs taken by the
+unsubscribe-processor wait in filtered_jobs with no consumer and a run
+could never drain. Chaining puts every job through filtering and delivery,
+so results include the unsubscribe-processor's cost. Use
+benchmarks/compare.py to diff two result files.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import redis  # noqa: E402
+from prometheus_client.parser import text_string_to_metric_families  # noqa: E402
+from common.lanes import LANE_NAMES, lane_keys  # noqa: E402
+from smtp_sink import SmtpSink  # noqa: E402
+
+SERVICES = {
+    "gateway": ("gateway-api", "gateway.py"),
+    "unsubscribe": ("unsubscribe-processor", "unsubscribe.py"),
+    "worker": ("worker", "worker.py"),
+    "retry": ("retry-handler", "retry.py"),
+}
+HISTOGRAMS = ("worker_queue_wait_seconds", "worker_end_to_end_seconds", "worker_stage_seconds")
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def parse_weights(spec):
+    """Parse 'a:3,b:1' into ([a, b], [3.0, 1.0])."""
+    names, weights = [], []
+    for item in spec.split(","):
+        name, _, weight = item.partition(":")
+        names.append(name.strip())
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def generate_jobs(args):
+    """Build /send payloads, either replayed from a JSONL file or generated from the mix options."""
+    if args.replay:
+        with open(args.replay) as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+        return jobs[:args.jobs] if args.jobs else jobs
+    rng = random.Random(args.seed)
+    lanes, lane_weights = parse_weights(args.lane_mix)
+    domains, domain_weights = parse_weights(args.domain_mix)
+    body = ("Lorem ipsum dolor sit amet. " * (args.body_bytes // 28 + 1))[:args.body_bytes]
+    jobs = []
+    for i in range(args.jobs):
+        jobs.append({
+            "from": f"sender{i % args.senders}@yourdomain.com",
+            "to": f"user{i}@{rng.choices(domains, domain_weights)[0]}",
+            "subject": f"Load test {i}",
+            "body": body,
+            "priority": rng.choices(lanes, lane_weights)[0],
+        })
+    return jobs
+
+
+def make_dkim_key(workdir):
+    """Generate a throwaway DKIM key so signing cost is measured; None if openssl is missing."""
+    if not shutil.which("openssl"):
+        return None
+    path = os.path.join(workdir, "dkim.private")
+    subprocess.run(["openssl", "genrsa", "-out", path, "2048"], check=True, capture_output=True)
+    return path
+
+
+def start_services(args, workdir, sink):
+    smtp_config = os.path.join(workdir, "smtp_rotation.json")
+    with open(smtp_config, "w") as f:
+        json.dump([{"id": "sink", "host": sink.host, "port": sink.port, "weight": 1.0}], f)
+    dkim_key = args.dkim_key or make_dkim_key(workdir) or os.path.join(workdir, "missing.private")
+    base = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        QUEUE_URL=args.redis,
+        LOG_LEVEL=args.log_level,
+        BLPOP_TIMEOUT="1",
+    )
+    specs = [
+        ("gateway", {"API_PORT": str(args.gateway_port), "JOB_QUEUE": "email_jobs",
+                     "RATE_LIMIT_PER_HOUR": str(10 ** 9)}),
+        ("unsubscribe", {"JOB_QUEUE": "email_jobs", "FILTERED_QUEUE": "filtered_jobs",
+                         "UNSUB_FILE": os.path.join(ROOT, "unsubscribe-processor", "unsub_list.json")}),
+        ("retry", {"FAILED_QUEUE": "failed_jobs", "RETRY_QUEUE": "email_jobs",
+                   "RETRY_POLICY_FILE": os.path.join(ROOT, "retry-handler", "retry_policy.json")}),
+    ]
+    for i in range(args.workers):
+        specs.append(("worker", {
+            "JOB_QUEUE": "filtered_jobs",
+            "METRICS_PORT": str(args.metrics_port + i),
+            "SMTP_CONFIG_FILE": smtp_config,
+            "DOMAIN_LIMITS_FILE": os.path.join(ROOT, "worker", "domain_limits.json"),
+            "DKIM_KEY_PATH": dkim_key,
+            "SENDER_RATE_LIMIT_PER_HOUR": str(10 ** 9),
+        }))
+    procs = []
+    for i, (name, env) in enumerate(specs):
+        service_dir, script = SERVICES[name]
+        log_dir = os.path.join(workdir, "logs", f"{name}{i}")
+        os.makedirs(log_dir, exist_ok=True)
+        out = open(os.path.join(log_dir, "stdout.log"), "w")
+        procs.append(subprocess.Popen(
+            [sys.executable, script],
+            cwd=os.path.join(ROOT, service_dir),
+            env=dict(base, LOG_DIR=log_dir, **env),
+            stdout=out,
+            stderr=subprocess.STDOUT,
+        ))
+    return procs
+
+
+def stop_services(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def wait_for_gateway(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Gateway did not become healthy at {url}")
+
+
+def submit(url, payload):
+    request = urllib.request.Request(
+        f"{url}/send", data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0
+    return status, time.perf_counter() - started
+
+
+class DepthSampler(threading.Thread):
+    """Samples queue depths and delivery counters at a fixed interval."""
+
+    def __init__(self, r, interval):
+        super().__init__(daemon=True)
+        self.r = r
+        self.interval = interval
+        self.samples = []
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.queues = {
+            "email_jobs": lane_keys("email_jobs"),
+            "filtered_jobs": lane_keys("filtered_jobs"),
+            "failed_jobs": ["failed_jobs"],
+            "delivered": ["delivered"],
+            "bounced": ["bounced"],
+            "permanent_failed": ["permanent_failed"],
+        }
+
+    def sample(self):
+        pipe = self.r.pipeline()
+        for keys in self.queues.values():
+            for key in keys:
+                pipe.llen(key)
+        results = pipe.execute()
+        sample = {"t": round(time.time() - self.start_time, 3)}
+        i = 0
+        for name, keys in self.queues.items():
+            sample[name] = sum(results[i:i + len(keys)])
+            i += len(keys)
+        sample["domain_shards"] = sum(self.r.llen(key) for key in self.r.scan_iter("domain_queue:*"))
+        sample["retry_scheduled"] = self.r.zcard("retry_scheduled")
+        sample["pending"] = sum(sample[name] for name in
+                                ("email_jobs", "filtered_jobs", "failed_jobs", "domain_shards", "retry_scheduled"))
+        self.samples.append(sample)
+        return sample
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+
+def histogram_quantile(q, buckets):
+    """Prometheus-style quantile estimate from cumulative (upper_bound, count) buckets."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    prev_bound, prev_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / max(count - prev_count, 1e-9)
+        prev_bound, prev_count = bound, count
+    return prev_bound
+
+
+def scrape_histograms(ports):
+    """Sum worker histogram buckets across all worker processes and reduce them to percentiles."""
+    buckets = {}
+    for port in ports:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+                text = resp.read().decode()
+        except (urllib.error.URLError, OSError):
+            continue
+        for family in text_string_to_metric_families(text):
+            if family.name not in HISTOGRAMS:
+                continue
+            for sample in family.samples:
+                if not sample.name.endswith("_bucket"):
+                    continue
+                labels = {k: v for k, v in sample.labels.items() if k != "le"}
+                series = (family.name, json.dumps(labels, sort_keys=True))
+                bound = float(sample.labels["le"])
+                buckets.setdefault(series, {}).setdefault(bound, 0.0)
+                buckets[series][bound] += sample.value
+    report = {}
+    for (name, labels), series in sorted(buckets.items()):
+        points = list(series.items())
+        entry = {"labels": json.loads(labels), "count": int(max(series.values()))}
+        for q in QUANTILES:
+            value = histogram_quantile(q, points)
+            entry[f"p{int(q * 100)}_s"] = round(value, 6) if value is not None else None
+        report.setdefault(name, []).append(entry)
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis", default="redis://localhost:6379/15", help="Redis URL; the database is flushed")
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--replay", help="JSONL file of /send payloads to replay instead of generating jobs")
+    parser.add_argument("--rate", type=float, default=0, help="Submissions per second (0 = as fast as possible)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Parallel HTTP submitters")
+    parser.add_argument("--lane-mix", default="high:1,normal:3,bulk:6")
+    parser.add_argument("--domain-mix", default="a.example:4,b.example:3,c.example:2,slow.example:1")
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--body-bytes", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--sink-latency", type=float, default=0.0, help="Seconds added per accepted message")
+    parser.add_argument("--sink-defer-domains", default="", help="Domains the sink always answers 451")
+    parser.add_argument("--sink-defer-rate", type=float, default=0.0, help="Share of recipients answered 451")
+    parser.add_argument("--sink-defer-delay", type=float, default=0.0)
+    parser.add_argument("--sink-reject-rate", type=float, default=0.0, help="Share of recipients answered 550")
+    parser.add_argument("--dkim-key", help="DKIM private key (default: generate one with openssl)")
+    parser.add_argument("--gateway-port", type=int, default=18080)
+    parser.add_argument("--metrics-port", type=int, default=18000)
+    parser.add_argument("--sample-interval", type=float, default=1.0)
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default="load_test_results.json")
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(args.redis, decode_responses=True)
+    r.flushdb()
+    jobs = generate_jobs(args)
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    sink = SmtpSink(
+        defer_domains=[d for d in args.sink_defer_domains.split(",") if d],
+        defer_delay=args.sink_defer_delay,
+        latency=args.sink_latency,
+        defer_rate=args.sink_defer_rate,
+        reject_rate=args.sink_reject_rate,
+    ).start()
+    procs = start_services(args, workdir, sink)
+    gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+    try:
+        wait_for_gateway(gateway_url)
+        sampler = DepthSampler(r, args.sample_interval)
+        sampler.start()
+
+        # Submit through the gateway, paced to --rate
+        submit_start = time.time()
+        statuses, submit_latencies = {}, []
+
+        def paced(item):
+            i, payload = item
+            if args.rate:
+                delay = submit_start + i / args.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            return submit(gateway_url, payload)
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for status, latency in pool.map(paced, enumerate(jobs)):
+                statuses[status] = statuses.get(status, 0) + 1
+                submit_latencies.append(latency)
+        submit_elapsed = time.time() - submit_start
+
+        # Drain: stop once nothing is pending for three samples in a row
+        deadline = time.time() + args.drain_timeout
+        idle = 0
+        while time.time() < deadline and idle < 3:
+            time.sleep(args.sample_interval)
+            idle = idle + 1 if sampler.sample()["pending"] == 0 else 0
+        sampler.stopped.set()
+        final = sampler.sample()
+
+        delivered = final["delivered"]
+        first_delivery = next((s["t"] for s in sampler.samples if s["delivered"]), None)
+        last_delivery = next((s["t"] for s in sampler.samples if s["delivered"] == delivered), None)
+        submit_latencies.sort()
+
+        results = {
+            "meta": {
+                "git_revision": git_revision(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "lanes": LANE_NAMES,
+                "args": vars(args),
+            },
+            "summary": {
+                "jobs": len(jobs),
+                "http_status": {str(k): v for k, v in sorted(statuses.items())},
+                "submit_seconds": round(submit_elapsed, 3),
+                "submit_rate_per_s": round(len(jobs) / submit_elapsed, 2) if submit_elapsed else None,
+                "submit_p50_s": round(submit_latencies[len(submit_latencies) // 2], 6) if submit_latencies else None,
+                "submit_p99_s": round(submit_latencies[int(len(submit_latencies) * 0.99)], 6)
+                if submit_latencies else None,
+                "delivered": delivered,
+                "bounced": final["bounced"],
+                "permanent_failed": final["permanent_failed"],
+                "pending_at_end": final["pending"],
+                "drained": final["pending"] == 0,
+                "first_delivery_s": first_delivery,
+                "last_delivery_s": last_delivery,
+                "throughput_per_s": round(delivered / last_delivery, 2) if last_delivery else None,
+                "sink": dict(sink.stats),
+            },
+            "latency": scrape_histograms([args.metrics_port + i for i in range(args.workers)]),
+            "timeseries": sampler.samples,
+        }
+    finally:
+        stop_services(procs)
+        sink.stop()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["summary"], indent=2))
+    print(f"Results written to {args.output}; service logs in {workdir}/logs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import random
+import socketserver
+import threading
+import time
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue with injected deferrals (4xx) and rejections (5xx) at RCPT."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink = self.server.sink
+        self.reply("220 smtp-sink ready")
+        refused = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 smtp-sink")
+            elif verb == "MAIL":
+                refused = False
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                domain = command.rsplit("@", 1)[-1].rstrip(">").lower()
+                if domain in sink.defer_domains or random.random() < sink.defer_rate:
+                    time.sleep(sink.defer_delay)
+                    refused = True
+                    sink.count("deferred", domain)
+                    self.reply("451 4.7.1 Try again later")
+                elif random.random() < sink.reject_rate:
+                    refused = True
+                    sink.count("rejected", domain)
+                    self.reply("550 5.1.1 User unknown")
+                else:
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                if refused:
+                    self.reply("554 No valid recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                time.sleep(sink.latency)
+                sink.count("accepted", None)
+                self.reply("250 OK queued")
+            elif verb == "RSET":
+                refused = False
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SmtpSink:
+    """Local SMTP server for benchmarks, run on a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, defer_domains=(), defer_delay=0.0, latency=0.0,
+                 defer_rate=0.0, reject_rate=0.0):
+        self.defer_domains = {d.lower() for d in defer_domains}
+        self.defer_delay = defer_delay
+        self.latency = latency
+        self.defer_rate = defer_rate
+        self.reject_rate = reject_rate
+        self.stats = {"accepted": 0, "deferred": 0, "rejected": 0}
+        self._lock = threading.Lock()
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), SinkHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+
+    def count(self, outcome, domain):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
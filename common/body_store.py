@@ -0,0 +1,120 @@
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+from os import getenv
+
+REF_PREFIX = "sha256:"
+
+
+class BodyNotFound(KeyError):
+    """Raised when a referenced body is no longer in the store (expired or never written)."""
+
+
+def body_ref(body):
+    """Content address of a body: identical bodies share one stored copy."""
+    return REF_PREFIX + hashlib.sha256(body.encode()).hexdigest()
+
+
+class RedisBodyStore:
+    """Bodies kept in Redis under body:<sha256> with a TTL refreshed on every reuse."""
+
+    def __init__(self, r, ttl):
+        self.r = r
+        self.ttl = ttl
+
+    def put(self, body):
+        ref = body_ref(body)
+        key = f"body:{ref[len(REF_PREFIX):]}"
+        # SET NX stores the first copy; later jobs with the same body only extend its TTL
+        if not self.r.set(key, body, nx=True, ex=self.ttl):
+            self.r.expire(key, self.ttl)
+        return ref
+
+    def get(self, ref):
+        body = self.r.get(f"body:{ref[len(REF_PREFIX):]}")
+        if body is None:
+            raise BodyNotFound(ref)
+        return body.decode() if isinstance(body, bytes) else body
+
+
+class FilesystemBodyStore:
+    """Bodies kept as files under a directory shared by the gateway and workers.
+
+    Files are written once, atomically, and never modified. Expiry is left to
+    the host (e.g. a periodic ``find -mtime`` cleanup), since a reused body
+    has its mtime refreshed on every put.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, ref):
+        digest = ref[len(REF_PREFIX):]
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, body):
+        ref = body_ref(body)
+        path = self._path(ref)
+        if os.path.exists(path):
+            os.utime(path)
+            return ref
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(body)
+        # mkstemp creates 0600 files; workers run as a different user than the gateway
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        return ref
+
+    def get(self, ref):
+        try:
+            with open(self._path(ref), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BodyNotFound(ref)
+
+
+class CachedBodyStore:
+    """LRU of recently fetched bodies in front of a store.
+
+    Content-addressed bodies never change, so cached entries never go stale.
+    Misses raise BodyNotFound, which lru_cache does not cache.
+    """
+
+    def __init__(self, store, size):
+        self.store = store
+        self.put = store.put
+        self.get = lru_cache(maxsize=size)(store.get)
+
+
+def make_body_store(r):
+    """Build the store selected by BODY_STORE (redis, fs or inline); None means bodies stay inline."""
+    kind = getenv("BODY_STORE", "redis").lower()
+    if kind == "redis":
+        return RedisBodyStore(r, int(getenv("BODY_STORE_TTL", str(7 * 86400))))
+    if kind == "fs":
+        return FilesystemBodyStore(getenv("BODY_STORE_DIR", "/app/bodies"))
+    return None
+
+
+def externalize_body(store, data, min_bytes=None):
+    """Replace a job's inline body with a store reference when it is large enough to be worth it."""
+    if min_bytes is None:
+        min_bytes = int(getenv("BODY_STORE_MIN_BYTES", "512"))
+    body = data.get("body")
+    if store is None or not isinstance(body, str) or len(body) < min_bytes:
+        return data
+    data["body_ref"] = store.put(body)
+    del data["body"]
+    return data
+
+
+def job_body(store, data):
+    """Inline body of a job, fetching it from the store when the job only carries a reference."""
+    if "body" in data:
+        return data["body"]
+    if store is None:
+        raise BodyNotFound(data.get("body_ref"))
+    return store.get(data["body_ref"])
@@ -0,0 +1,81 @@
+import json
+import threading
+from os import getenv
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Version byte at the start of every binary payload. Legacy JSON payloads start
+# with "{", msgpack maps with 0x8X/0xDE/0xDF, so neither collides with these.
+MSGPACK_V1 = 0x01
+MSGPACK_ZSTD_V1 = 0x02
+
+JOB_CODEC = getenv("JOB_CODEC", "msgpack").lower()
+ZSTD_MIN_BYTES = int(getenv("JOB_CODEC_ZSTD_MIN_BYTES", "4096"))
+ZSTD_LEVEL = int(getenv("JOB_CODEC_ZSTD_LEVEL", "3"))
+
+# zstandard (de)compressor objects are not safe to share between threads
+_local = threading.local()
+
+
+def _compressor():
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _local.compressor
+
+
+def _decompressor():
+    if not hasattr(_local, "decompressor"):
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor
+
+
+def encode_job(data, codec=None):
+    """Serialize a job for a Redis queue.
+
+    ``msgpack`` payloads are a version byte followed by the msgpack map,
+    zstd-compressed when at least ZSTD_MIN_BYTES long (large inline bodies).
+    ``json`` writes the legacy format every service used before.
+    """
+    codec = codec or JOB_CODEC
+    if codec != "msgpack" or msgpack is None:
+        return json.dumps(data)
+    packed = msgpack.packb(data, use_bin_type=True)
+    if zstandard is not None and len(packed) >= ZSTD_MIN_BYTES:
+        return bytes([MSGPACK_ZSTD_V1]) + _compressor().compress(packed)
+    return bytes([MSGPACK_V1]) + packed
+
+
+def decode_job(raw):
+    """Deserialize a job written by encode_job or by a pre-codec service (plain JSON).
+
+    Raises ValueError for payloads that are neither.
+    """
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if not raw:
+        raise ValueError("Empty job payload")
+    version = raw[0]
+    if version == MSGPACK_V1:
+        return msgpack.unpackb(raw[1:], raw=False)
+    if version == MSGPACK_ZSTD_V1:
+        if zstandard is None:
+            raise ValueError("zstd-compressed job but zstandard is not installed")
+        try:
+            packed = _decompressor().decompress(raw[1:])
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Corrupt zstd job payload: {e}") from e
+        return msgpack.unpackb(packed, raw=False)
+    return json.loads(raw)
+
+
+def as_text(value):
+    """Redis keys/members come back as bytes from binary clients; normalize them to str."""
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,31 @@
+import time
+
+# Why a worker gave up on a delivery attempt, recorded on jobs pushed to failed_jobs
+FAILURE_SMTP = "smtp"  # the relay answered with an SMTP error; smtp_code holds the reply code
+FAILURE_CONNECTION = "connection"  # relay unreachable, timed out or dropped the session
+FAILURE_RATE_LIMITED = "rate_limited"  # sender over SENDER_RATE_LIMIT_PER_HOUR
+FAILURE_INVALID = "invalid"  # job is missing required fields
+FAILURE_MISSING_BODY = "missing_body"  # body_ref no longer in the body store
+FAILURE_ERROR = "error"  # anything else (DKIM, MIME, bugs)
+
+
+def recipient_domain(data):
+    """Return the lower-cased domain of the job's first recipient."""
+    to = data.get("to")
+    if isinstance(to, list):
+        to = to[0] if to else None
+    if not isinstance(to, str) or "@" not in to:
+        return "unknown"
+    return to.rsplit("@", 1)[1].strip().lower() or "unknown"
+
+
+def mark_failed(data, failure, error=None, smtp_code=None, relay=None):
+    """Record why the latest attempt failed, replacing details left by earlier attempts."""
+    data["failure"] = failure
+    data["failed_at"] = time.time()
+    for field, value in (("error", error), ("smtp_code", smtp_code), ("relay", relay)):
+        if value is None:
+            data.pop(field, None)
+        else:
+            data[field] = value
+    return data
@@ -0,0 +1,145 @@
+import time
+from os import getenv
+from common.job_codec import as_text
+
+
+def parse_lanes(spec):
+    """Parse 'high:10,normal:3,bulk:1' into an ordered list of (lane, weight)."""
+    lanes = []
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name:
+            lanes.append((name, max(1, int(weight or 1))))
+    return lanes
+
+
+LANES = parse_lanes(getenv("PRIORITY_LANES", "high:10,normal:3,bulk:1"))
+LANE_NAMES = [name for name, _ in LANES]
+DEFAULT_LANE = getenv("DEFAULT_LANE", "normal")
+
+
+def lane_key(queue, lane):
+    """Redis list holding one lane of a queue, e.g. email_jobs:high."""
+    return f"{queue}:{lane}"
+
+
+def lane_keys(queue):
+    """All lane keys of a queue, highest priority first."""
+    return [lane_key(queue, lane) for lane in LANE_NAMES]
+
+
+def consumer_queues(queue):
+    """(lane, key) pairs a consumer of a queue reads: every lane, then the plain pre-lane list.
+
+    Producers from before priority lanes pushed to the queue key itself; those
+    jobs are read (and counted) as DEFAULT_LANE, so none are stranded by an upgrade.
+    """
+    return [(lane, lane_key(queue, lane)) for lane in LANE_NAMES] + [(DEFAULT_LANE, queue)]
+
+
+def lane_from_key(queue, key):
+    if key == queue:
+        return DEFAULT_LANE
+    return key[len(queue) + 1:]
+
+
+def job_lane(data):
+    """Lane a job travels in; unknown or missing priorities use the default lane."""
+    lane = str(data.get("priority") or DEFAULT_LANE).lower()
+    return lane if lane in LANE_NAMES else DEFAULT_LANE
+
+
+class WeightedLaneScheduler:
+    """Smooth weighted round robin across lanes with starvation protection.
+
+    Among the lanes that currently have work, each pick adds every lane's weight
+    to its running credit and serves the lane with the most credit, so lanes
+    are interleaved in proportion to their weights. A lane that has had work
+    but has not been served for ``starvation_seconds`` is served next
+    regardless of credit.
+    """
+
+    def __init__(self, lanes=None, starvation_seconds=None):
+        self.lanes = lanes or LANES
+        self.weights = dict(self.lanes)
+        self.order = [name for name, _ in self.lanes]
+        self.starvation_seconds = starvation_seconds if starvation_seconds is not None else \
+            float(getenv("LANE_STARVATION_SECONDS", "30"))
+        self.credit = {name: 0 for name in self.order}
+        self.last_served = {name: time.time() for name in self.order}
+
+    def pick(self, candidates):
+        """Choose the lane to serve next from the lanes that have work."""
+        for lane in self.order:
+            if lane not in candidates:
+                self.idle(lane)
+        candidates = [lane for lane in self.order if lane in candidates]
+        if not candidates:
+            return None
+        now = time.time()
+        starved = [lane for lane in candidates if now - self.last_served[lane] > self.starvation_seconds]
+        total = sum(self.weights[lane] for lane in candidates)
+        for lane in candidates:
+            self.credit[lane] += self.weights[lane]
+        lane = min(starved, key=lambda name: self.last_served[name]) if starved else max(candidates, key=lambda name: self.credit[name])
+        self.credit[lane] -= total
+        self.served(lane)
+        return lane
+
+    def pick_from(self, candidates, take):
+        """Serve the lane picked next for which ``take(lane)`` returns work; return (lane, work) or None.
+
+        A lane whose ``take`` comes back empty (every domain held back by its
+        limits) is not charged: the pick is undone and the lane is treated as
+        having no work while the remaining lanes are tried.
+        """
+        candidates = set(candidates)
+        while candidates:
+            credit, last_served = dict(self.credit), dict(self.last_served)
+            lane = self.pick(candidates)
+            work = take(lane)
+            if work is not None:
+                return lane, work
+            self.credit, self.last_served = credit, last_served
+            candidates.discard(lane)
+        return None
+
+    def served(self, lane):
+        self.last_served[lane] = time.time()
+
+    def idle(self, lane):
+        """Reset a lane without work so it neither banks credit nor looks starved later."""
+        self.credit[lane] = 0
+        self.last_served[lane] = time.time()
+
+    def pop(self, r, lane_queues, timeout, legacy_queue=None):
+        """Pop (lane, raw_job) from the lane picked next, blocking up to ``timeout`` when all are empty.
+
+        Jobs in ``legacy_queue`` (the plain pre-lane list) are the oldest and
+        are served first, as DEFAULT_LANE, until it is empty.
+        """
+        pipe = r.pipeline()
+        for queue in lane_queues.values():
+            pipe.llen(queue)
+        if legacy_queue:
+            pipe.llen(legacy_queue)
+        lengths = pipe.execute()
+        if legacy_queue and lengths.pop():
+            raw = r.lpop(legacy_queue)
+            if raw is not None:
+                self.served(DEFAULT_LANE)
+                return DEFAULT_LANE, raw
+        lane = self.pick({lane for lane, length in zip(lane_queues, lengths) if length})
+        if lane:
+            raw = r.lpop(lane_queues[lane])
+            if raw is not None:
+                return lane, raw
+        # Nothing queued (or another consumer won the race): block on all lanes, highest first
+        keys = list(lane_queues.values()) + ([legacy_queue] if legacy_queue else [])
+        job = r.blmpop(timeout, len(keys), *keys, direction="LEFT")
+        if not job:
+            return None
+        key, raws = job
+        lane = next((name for name, queue in lane_queues.items() if queue == as_text(key)), DEFAULT_LANE)
+        self.served(lane)
+        return lane, raws[0]
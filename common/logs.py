@@ -0,0 +1,247 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import socket
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from os import getenv
+
+try:
+    from pythonjsonlogger import jsonlogger
+except ImportError:
+    jsonlogger = None
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+# Process-wide counters, read by log_stats() and the periodic drop report
+_stats = {"dropped": 0, "suppressed": 0}
+_stats_lock = threading.Lock()
+# One entry per setup_logging() call: what after_fork() has to rebuild in a child
+_pipelines = []
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def log_stats():
+    """Records lost so far: dropped (writer queue full) and suppressed (per-job rate limit/sampling)."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller: when the writer falls behind, records are dropped and counted."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count("dropped")
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """Rotates at the end of each interval and whenever the file grows past max_bytes.
+
+    Rotated files are named <file>.<interval start>.<seq>, so several size
+    rollovers within one interval never overwrite each other. The sequence
+    always grows within an interval, and backupCount keeps the newest files
+    by modification time across both kinds of rollover.
+    """
+
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        return self.stream.tell() >= self.max_bytes
+
+    def _backups(self):
+        """Rotated files of this log as (path, stamp, seq)."""
+        dirname, basename = os.path.split(self.baseFilename)
+        prefix = basename + "."
+        backups = []
+        for name in os.listdir(dirname):
+            if not name.startswith(prefix):
+                continue
+            stamp, _, seq = name[len(prefix):].rpartition(".")
+            if seq.isdigit() and self.extMatch.match(stamp):
+                backups.append((os.path.join(dirname, name), stamp, int(seq)))
+        return backups
+
+    def getFilesToDelete(self):
+        # By age rather than by name: sequence numbers do not sort across intervals
+        backups = sorted(self._backups(), key=lambda backup: (os.path.getmtime(backup[0]), backup[2]))
+        return [path for path, _, _ in backups[:max(0, len(backups) - self.backupCount)]]
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = int(time.time())
+        start = self.rolloverAt - self.interval
+        stamp = time.strftime(self.suffix, time.gmtime(start) if self.utc else time.localtime(start))
+        # Continue after the highest sequence of the interval, so pruned low numbers are never reused
+        seq = max((backup_seq for _, backup_stamp, backup_seq in self._backups() if backup_stamp == stamp),
+                  default=0) + 1
+        self.rotate(self.baseFilename, self.rotation_filename(f"{self.baseFilename}.{stamp}.{seq:03d}"))
+        if self.backupCount > 0:
+            for path in self.getFilesToDelete():
+                os.remove(path)
+        if not self.delay:
+            self.stream = self._open()
+        if now >= self.rolloverAt:
+            self.rolloverAt = self.computeRollover(now)
+
+
+class JobLogLimiter(logging.Filter):
+    """Token bucket plus random sampling for per-job records, so INFO-per-job logging stays bounded at high throughput."""
+
+    def __init__(self, rate_per_sec, sample_rate=1.0):
+        super().__init__()
+        self.rate = rate_per_sec
+        self.sample_rate = sample_rate
+        self.tokens = float(rate_per_sec)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            _count("suppressed")
+            return False
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+        _count("suppressed")
+        return False
+
+
+def _report_drops(logger, interval):
+    last = log_stats()
+    while True:
+        time.sleep(interval)
+        current = log_stats()
+        dropped = current["dropped"] - last["dropped"]
+        suppressed = current["suppressed"] - last["suppressed"]
+        if dropped or suppressed:
+            logger.warning(f"Log records lost in the last {interval}s: {dropped} dropped (writer queue full), "
+                           f"{suppressed} per-job records suppressed (rate limit/sampling)")
+        last = current
+
+
+def setup_logging(name, service, formatter=None, log_dir=None):
+    """Configure `name` to log through a background writer thread and return the logger.
+
+    Callers only enqueue records; a QueueListener formats them and writes to
+    stdout and <LOG_DIR>/<service>.log (rotated by size and time). With
+    LOG_FILE_PER_HOST=true the file is <service>-<hostname>.log, for
+    replicas that share one log volume.
+    """
+    log_dir = log_dir or getenv("LOG_DIR", "/app/logs")
+    os.makedirs(log_dir, exist_ok=True)
+    if formatter is None:
+        formatter = (jsonlogger.JsonFormatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT) if jsonlogger
+                     else logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+
+    file_name = service
+    if getenv("LOG_FILE_PER_HOST", "false").lower() == "true":
+        file_name = f"{service}-{socket.gethostname()}"
+    file_handler = SizedTimedRotatingFileHandler(
+        os.path.join(log_dir, f"{file_name}.log"),
+        max_bytes=int(getenv("LOG_ROTATE_MAX_BYTES", str(50 * 1024 * 1024))),
+        when=getenv("LOG_ROTATE_WHEN", "midnight"),
+        backupCount=int(getenv("LOG_ROTATE_BACKUPS", "14")),
+        encoding="utf-8",
+    )
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=int(getenv("LOG_QUEUE_SIZE", "10000")))
+    listener = QueueListener(records, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    logger = logging.getLogger(name)
+    logger.setLevel(getenv("LOG_LEVEL", "INFO"))
+    handler = DroppingQueueHandler(records)
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    report_interval = int(getenv("LOG_DROP_REPORT_SECONDS", "60"))
+    if report_interval > 0:
+        threading.Thread(target=_report_drops, args=(logger, report_interval), daemon=True).start()
+    _pipelines.append({"logger": logger, "handler": handler, "listener": listener,
+                       "file_handler": file_handler, "report_interval": report_interval})
+    return logger
+
+
+def job_logger(logger):
+    """Child of `logger` for per-job INFO messages, limited by LOG_JOB_RATE_PER_SEC and LOG_JOB_SAMPLE_RATE.
+
+    Warnings and errors logged through it always pass.
+    """
+    child = logger.getChild("jobs")
+    if not any(isinstance(f, JobLogLimiter) for f in child.filters):
+        child.addFilter(JobLogLimiter(
+            float(getenv("LOG_JOB_RATE_PER_SEC", "50")),
+            float(getenv("LOG_JOB_SAMPLE_RATE", "1.0")),
+        ))
+    return child
+
+
+def after_fork(file_suffix=None):
+    """Give a forked child its own writer threads, which fork does not copy.
+
+    The queues are replaced too, since the parent's writer may have held
+    their locks at the moment of the fork. With file_suffix the child writes
+    to <file>-<suffix>.log, so processes never rotate each other's file; set
+    LOG_FILE_PER_HOST as well when several hosts share the log directory.
+    """
+    global _stats_lock
+    _stats_lock = threading.Lock()
+    _stats.update(dropped=0, suppressed=0)
+    for pipeline in _pipelines:
+        records = queue.Queue(maxsize=pipeline["handler"].queue.maxsize)
+        pipeline["handler"].queue = records
+        listener = pipeline["listener"]
+        listener.queue = records
+        listener._thread = None
+        if file_suffix is not None:
+            file_handler = pipeline["file_handler"]
+            root, ext = os.path.splitext(file_handler.baseFilename)
+            file_handler.stream = None
+            file_handler.baseFilename = f"{root}-{file_suffix}{ext}"
+        listener.start()
+        if pipeline["report_interval"] > 0:
+            threading.Thread(target=_report_drops, args=(pipeline["logger"], pipeline["report_interval"]),
+                             daemon=True).start()
+
+
+@atexit.register
+def shutdown_logging():
+    """Write out whatever is still queued; runs at exit, call it before os._exit()."""
+    for pipeline in _pipelines:
+        try:
+            pipeline["listener"].stop()
+        except (queue.Full, AttributeError):
+            pass
+    _pipelines.clear()
@@ -1,31 +1,23 @@
 from flask import Flask, request, jsonify
 import redis
-import json
 import time
-import logging
 import os
 import uuid
-from pythonjsonlogger import jsonlogger
+from common.lanes import LANE_NAMES, job_lane, lane_key
+from common.body_store import externalize_body, make_body_store
+from common.job_codec import encode_job
+from common.logs import job_logger, setup_logging
 
 # ENV
 REDIS_URL = os.getenv("QUEUE_URL", "redis://queue:6379/0")
 JOB_QUEUE = os.getenv("JOB_QUEUE", "email_jobs")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 API_PORT = int(os.getenv("API_PORT", 8080))
+RATE_LIMIT_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_HOUR", 100))
 
-# Logging setup
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"gateway_{time.strftime('%Y%m%d')}.log")
-logger = logging.getLogger("gateway")
-logger.setLevel(LOG_LEVEL)
-formatter = jsonlogger.JsonFormatter(fmt="%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Logging setup (background writer; per-request INFO lines are rate limited)
+logger = setup_logging("gateway", "gateway")
+job_log = job_logger(logger)
 
 # Init Flask app
 app = Flask(__name__)
@@ -39,7 +31,12 @@ except redis.RedisError as e:
     logger.critical(f"Failed to connect to Redis: {e}")
     raise
 
+# Large bodies are stored once by content hash; queued jobs carry only the reference
+body_store = make_body_store(r)
+
 def validate_job(data):
+    if "priority" in data and str(data["priority"]).lower() not in LANE_NAMES:
+        return False
     return all(field in data for field in ["from", "to", "subject", "body"])
 
 @app.route("/", methods=["GET"])
@@ -81,7 +78,7 @@ def send():
         count = r.incr(key)
         if count == 1:
             r.expire(key, 3600)
-        if count > 100:
+        if count > RATE_LIMIT_PER_HOUR:
             logger.warning(f"{trace_id} - Rate limit exceeded: {ip}")
             return jsonify({"error": "Too many requests"}), 429
 
@@ -94,18 +91,22 @@ def send():
             data["body"] = template.format(**data.get("template_data", {}))
 
         job_id = str(uuid.uuid4())
+        lane = job_lane(data)
         data.update({
             "job_id": job_id,
+            "priority": lane,
             "submitted_at": time.time(),
             "client_ip": ip
         })
 
-        r.rpush(JOB_QUEUE, json.dumps(data))
-        logger.info(f"{trace_id} - Queued job: {job_id}")
+        externalize_body(body_store, data)
+        r.rpush(lane_key(JOB_QUEUE, lane), encode_job(data))
+        job_log.info(f"{trace_id} - Queued job: {job_id} ({lane})")
 
         return jsonify({
             "status": "queued",
             "job_id": job_id,
+            "priority": lane,
             "submitted_at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
         }), 202
 
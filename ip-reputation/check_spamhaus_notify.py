@@ -1,30 +1,14 @@
 import dns.resolver
 import time
 import smtplib
-import logging
-import os
 import ipaddress
 from email.mime.text import MIMEText
-from pythonjsonlogger import jsonlogger
 from os import getenv
 import redis
+from common.logs import setup_logging
 
 # Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"ip_reputation_{time.strftime('%Y%m%d')}.log")
-logger = logging.getLogger(__name__)
-logger.setLevel(getenv("LOG_LEVEL", "INFO"))
-formatter = jsonlogger.JsonFormatter(
-    fmt="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+logger = setup_logging(__name__, "ip_reputation")
 
 def load_ips(blacklist_file):
     """Load and validate IPs from blacklist.txt."""
@@ -1,29 +1,27 @@
 import redis
 import time
 import logging
-import os
 import signal
-from datetime import datetime
 from os import getenv
-from logging.handlers import RotatingFileHandler
 from tenacity import retry, stop_after_attempt, wait_exponential, stop_after_delay
 from prometheus_client import Gauge, Counter, start_http_server
+from common.lanes import DEFAULT_LANE, LANE_NAMES, lane_key
+from common.job_codec import decode_job
+from common.logs import setup_logging
 
 # Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"mailq_logger_{datetime.now().strftime('%Y%m%d')}.log")
-handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5)
-logging.basicConfig(
-    level=getenv("LOG_LEVEL", "INFO"),
-    format="%(asctime)s [%(levelname)s] [Queue Length] %(message)s",
-    handlers=[handler, logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
+logger = setup_logging(__name__, "mailq_logger",
+                       formatter=logging.Formatter("%(asctime)s [%(levelname)s] [Queue Length] %(message)s"))
 
 # Prometheus metrics
 TOTAL_CHECKS = Counter("queue_checks_total", "Total number of queue checks")
-QUEUE_LENGTH = Gauge("queue_length", "Current length of email_jobs queue")
+QUEUE_LENGTH = Gauge("queue_length", "Current length of email_jobs queue across all lanes")
+LANE_LENGTH = Gauge("lane_queue_length", "Current length of each email_jobs priority lane", ["lane"])
+LANE_OLDEST_AGE = Gauge("lane_oldest_job_age_seconds", "How long the job at the head of each lane has waited", ["lane"])
+LANE_WAIT_SUM = Gauge("lane_queue_wait_seconds_sum", "Total queue wait of jobs picked up by workers, per lane", ["lane"])
+LANE_DEQUEUED = Gauge("lane_dequeued_jobs", "Jobs picked up by workers for a first attempt, per lane", ["lane"])
+
+JOB_QUEUE = getenv("JOB_QUEUE", "email_jobs")
 
 # Handle graceful shutdown
 def handle_shutdown(signum, frame):
@@ -34,19 +32,53 @@ signal.signal(signal.SIGTERM, handle_shutdown)
 signal.signal(signal.SIGINT, handle_shutdown)
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def check_queue_length(r):
-    return r.llen("email_jobs")
+def check_lanes(r):
+    """Return {lane: (length, head job, queue wait sum, dequeued count)}.
+
+    Jobs left in the plain pre-lane list are consumed as DEFAULT_LANE, so
+    they are counted there, and its older head job wins.
+    """
+    pipe = r.pipeline()
+    for lane in LANE_NAMES:
+        pipe.llen(lane_key(JOB_QUEUE, lane))
+        pipe.lindex(lane_key(JOB_QUEUE, lane), 0)
+        pipe.get(f"worker_metrics:queue_wait_seconds:{lane}")
+        pipe.get(f"worker_metrics:dequeued:{lane}")
+    pipe.llen(JOB_QUEUE)
+    pipe.lindex(JOB_QUEUE, 0)
+    results = pipe.execute()
+    lanes = {lane: results[i * 4:i * 4 + 4] for i, lane in enumerate(LANE_NAMES)}
+    legacy_length, legacy_head = results[-2:]
+    if legacy_length and DEFAULT_LANE in lanes:
+        lanes[DEFAULT_LANE][0] += legacy_length
+        lanes[DEFAULT_LANE][1] = legacy_head
+    return lanes
+
+def head_age(head, now):
+    """Seconds the head job of a lane has been waiting since the gateway queued it."""
+    try:
+        return max(0.0, now - float(decode_job(head)["submitted_at"]))
+    except (TypeError, ValueError, KeyError):
+        return 0.0
 
 @retry(stop=stop_after_delay(300))
 def main():
     # Start Prometheus HTTP server
     start_http_server(8000)
     redis_url = getenv("REDIS_URL", "redis://queue:6379/0")
-    r = redis.Redis.from_url(redis_url, decode_responses=True)
+    # Binary client: the lane heads are msgpack job payloads
+    r = redis.Redis.from_url(redis_url)
     while True:
         try:
-            length = check_queue_length(r)
-            logger.info(f"Queue length: {length}")
+            lanes = check_lanes(r)
+            now = time.time()
+            for lane, (lane_length, head, wait_sum, dequeued) in lanes.items():
+                LANE_LENGTH.labels(lane=lane).set(lane_length)
+                LANE_OLDEST_AGE.labels(lane=lane).set(head_age(head, now) if head else 0)
+                LANE_WAIT_SUM.labels(lane=lane).set(float(wait_sum or 0))
+                LANE_DEQUEUED.labels(lane=lane).set(int(dequeued or 0))
+            length = sum(values[0] for values in lanes.values())
+            logger.info(f"Queue length: {length} " + " ".join(f"{lane}={values[0]}" for lane, values in lanes.items()))
             QUEUE_LENGTH.set(length)
             TOTAL_CHECKS.inc()
             if length > 1000:
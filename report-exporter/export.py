@@ -2,27 +2,12 @@ import redis
 import json
 import time
 import os
-import logging
-from datetime import datetime
-from pythonjsonlogger import jsonlogger
 from os import getenv
+from common.job_codec import decode_job
+from common.logs import setup_logging
 
 # Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"report_exporter_{datetime.now().strftime('%Y%m%d')}.log")
-logger = logging.getLogger(__name__)
-logger.setLevel(getenv("LOG_LEVEL", "INFO"))
-formatter = jsonlogger.JsonFormatter(
-    fmt="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+logger = setup_logging(__name__, "report_exporter")
 
 def cleanup_old_reports(report_dir, max_age_days=30):
     """Delete reports older than max_age_days to manage disk usage."""
@@ -36,6 +21,13 @@ def cleanup_old_reports(report_dir, max_age_days=30):
     except Exception as e:
         logger.error(f"Failed to clean up old reports: {e}")
 
+def report_item(raw):
+    """Decoded job for the report; items that are not jobs are kept as text."""
+    try:
+        return decode_job(raw)
+    except ValueError:
+        return raw.decode(errors="replace")
+
 def main():
     try:
         # Configuration from environment variables
@@ -47,6 +39,8 @@ def main():
 
         os.makedirs(report_dir, exist_ok=True)
         r = redis.Redis.from_url(redis_url, decode_responses=True)
+        # Binary client for the job lists (msgpack payloads)
+        q = redis.Redis.from_url(redis_url)
 
         while True:
             try:
@@ -54,7 +48,7 @@ def main():
                 cleanup_old_reports(report_dir, max_report_age)
 
                 # Fetch data from Redis with pipelining
-                pipe = r.pipeline()
+                pipe = q.pipeline()
                 for key in redis_keys:
                     pipe.llen(key)
                     pipe.lrange(key, 0, -1)
@@ -67,7 +61,7 @@ def main():
                     items = results[i * 2 + 1]
                     report[key] = {
                         "count": count,
-                        "items": items
+                        "items": [report_item(item) for item in items]
                     }
 
                 # Write report
@@ -1,38 +1,36 @@
+import math
 import redis
-import json
 import time
-import logging
-import os
-from datetime import datetime
-from pythonjsonlogger import jsonlogger
 from os import getenv
+from common.lanes import job_lane, lane_key
+from common.job_codec import decode_job, encode_job
+from common.logs import job_logger, setup_logging
+from retry_policy import DEAD_LETTER, RetryPolicy, load_retry_policy
 
-# Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"retry_handler_{datetime.now().strftime('%Y%m%d')}.log")
-logger = logging.getLogger(__name__)
-logger.setLevel(getenv("LOG_LEVEL", "INFO"))
-formatter = jsonlogger.JsonFormatter(
-    fmt="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Configure logging (background writer; per-job INFO lines are rate limited)
+logger = setup_logging("retry_handler", "retry_handler")
+job_log = job_logger(logger)
+
+# Move one scheduled retry back to its lane, unless another handler already did
+RELEASE_DUE = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+return 0
+"""
 
 def validate_job(data):
-    """Validate job data structure."""
-    required_fields = ["job_id", "recipient", "sender"]
+    """Validate job data structure (the fields the worker needs to resend it)."""
+    required_fields = ["job_id", "from", "to"]
     return all(field in data for field in required_fields)
 
-def calculate_backoff(retry_count, base_delay=2, max_delay=60):
-    """Calculate exponential backoff delay."""
-    delay = min(base_delay * (2 ** retry_count), max_delay)
-    return delay
+def release_due(q, release, schedule_key, retry_queue, limit=100):
+    """Requeue scheduled retries whose time has come; return seconds until the next one (None if none)."""
+    now = time.time()
+    for raw in q.zrangebyscore(schedule_key, "-inf", now, start=0, num=limit):
+        release(keys=[schedule_key, lane_key(retry_queue, job_lane(decode_job(raw)))], args=[raw])
+    upcoming = q.zrange(schedule_key, 0, 0, withscores=True)
+    return max(0.0, upcoming[0][1] - time.time()) if upcoming else None
 
 def main():
     try:
@@ -41,25 +39,34 @@ def main():
         failed_queue = getenv("FAILED_QUEUE", "failed_jobs")
         retry_queue = getenv("RETRY_QUEUE", "email_jobs")
         dead_letter_queue = getenv("DEAD_LETTER_QUEUE", "permanent_failed")
+        schedule_key = getenv("RETRY_SCHEDULE_KEY", "retry_scheduled")
+        policy_file = getenv("RETRY_POLICY_FILE", "/app/retry_policy.json")
         max_retries = int(getenv("MAX_RETRIES", "3"))
         base_delay = float(getenv("BASE_DELAY_SECONDS", "2"))
         max_delay = float(getenv("MAX_DELAY_SECONDS", "60"))
         timeout = int(getenv("BLPOP_TIMEOUT", "5"))
 
         r = redis.Redis.from_url(redis_url, decode_responses=True)
+        # Binary client for job payloads (msgpack); r stays for counters
+        q = redis.Redis.from_url(redis_url)
+        release = q.register_script(RELEASE_DUE)
+        policy = RetryPolicy(r, load_retry_policy(policy_file, max_retries, base_delay, max_delay))
         logger.info("Retry handler started")
 
         while True:
             try:
-                job = r.blpop(failed_queue, timeout=timeout)
+                # Retries wait in a sorted set instead of a sleep, so one long backoff never holds up the rest
+                next_due = release_due(q, release, schedule_key, retry_queue)
+                wait = timeout if next_due is None else max(1, min(timeout, math.ceil(next_due)))
+                job = q.blpop(failed_queue, timeout=wait)
                 if not job:
                     continue
 
                 job_data = job[1]
                 try:
-                    data = json.loads(job_data)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Invalid JSON in job: {job_data}, error: {e}")
+                    data = decode_job(job_data)
+                except ValueError as e:
+                    logger.error(f"Undecodable job: {job_data!r}, error: {e}")
                     r.incr("retry_metrics:json_errors")
                     continue
 
@@ -71,19 +78,24 @@ def main():
 
                 job_id = data.get("job_id", "unknown")
                 retries = data.get("retries", 0)
-                logger.info(f"Processing job {job_id}, retry {retries + 1}")
+                action, delay, failure_class = policy.decide(data)
+                job_log.info(f"Processing job {job_id}, retry {retries + 1}, failure class {failure_class}")
 
-                if retries < max_retries:
+                if action == DEAD_LETTER:
+                    data["dead_letter_reason"] = failure_class
+                    logger.warning(f"Job {job_id} not retried ({failure_class} failure after {retries} retries), "
+                                   f"moving to {dead_letter_queue}")
+                    r.rpush(dead_letter_queue, encode_job(data))
+                    r.incr("retry_metrics:permanent_failures")
+                    r.incr(f"retry_metrics:dead_lettered:{failure_class}")
+                else:
                     data["retries"] = retries + 1
-                    delay = calculate_backoff(retries, base_delay, max_delay)
-                    logger.info(f"Scheduling retry for job {job_id} after {delay}s")
-                    time.sleep(delay)  # Apply backoff delay
-                    r.rpush(retry_queue, json.dumps(data))
+                    # A fresh deferral budget, so a 4xx on the retry backs its domain off again
+                    data.pop("deferrals", None)
+                    job_log.info(f"Scheduling retry for job {job_id} after {delay:.1f}s")
+                    q.zadd(schedule_key, {encode_job(data): time.time() + delay})
                     r.incr("retry_metrics:retries")
-                else:
-                    logger.warning(f"Job {job_id} reached max retries, moving to {dead_letter_queue}")
-                    r.rpush(dead_letter_queue, json.dumps(data))
-                    r.incr("retry_metrics:permanent_failures")
+                    r.incr(f"retry_metrics:retries:{failure_class}")
 
             except redis.RedisError as e:
                 logger.error(f"Redis error: {e}")
@@ -0,0 +1,145 @@
+import json
+import logging
+import random
+from common.jobs import (FAILURE_CONNECTION, FAILURE_INVALID, FAILURE_MISSING_BODY, FAILURE_RATE_LIMITED,
+                         recipient_domain)
+
+logger = logging.getLogger("retry_handler.policy")  # Child of the retry handler logger set up by setup_logging
+
+# Failure classes
+TRANSIENT = "transient"  # 4xx: the destination wants us to come back later
+PERMANENT = "permanent"  # 5xx: resending the same message cannot succeed
+CONNECTION = "connection"  # relay unreachable or timed out; says nothing about the job itself
+RATE_LIMITED = "rate_limited"  # our own per-sender limit
+INVALID = "invalid"  # malformed job or expired body
+UNKNOWN = "unknown"
+
+RETRY = "retry"
+DEAD_LETTER = "dead_letter"
+
+
+def default_policy(max_retries=3, base_delay=2, max_delay=60):
+    """Built-in policy; the legacy MAX_RETRIES/BASE_DELAY/MAX_DELAY settings drive the unknown class."""
+    return {
+        "classes": {
+            TRANSIENT: {"max_retries": 5, "base_delay": 60, "max_delay": 3600},
+            CONNECTION: {"max_retries": 8, "base_delay": 15, "max_delay": 900,
+                         "outage_window": 300, "outage_base_delay": 15},
+            RATE_LIMITED: {"max_retries": 6, "base_delay": 300, "max_delay": 3600},
+            UNKNOWN: {"max_retries": max_retries, "base_delay": base_delay, "max_delay": max_delay},
+            PERMANENT: {"max_retries": 0},
+            INVALID: {"max_retries": 0},
+        },
+        "domains": {
+            "default": {"failure_window": 600, "base_delay": 30, "max_delay": 1800},
+        },
+    }
+
+
+def load_retry_policy(policy_file, max_retries=3, base_delay=2, max_delay=60):
+    """Merge the per-class and per-domain settings of policy_file over the built-in policy."""
+    policy = default_policy(max_retries, base_delay, max_delay)
+    try:
+        with open(policy_file) as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"Retry policy file {policy_file} not found, using defaults")
+        return policy
+    for section in ("classes", "domains"):
+        for name, settings in overrides.get(section, {}).items():
+            policy[section].setdefault(name, {}).update(settings)
+    return policy
+
+
+def classify(data):
+    """Failure class of a job from what the worker recorded about its last attempt."""
+    failure = data.get("failure")
+    if failure in (FAILURE_INVALID, FAILURE_MISSING_BODY):
+        return INVALID
+    if failure == FAILURE_RATE_LIMITED:
+        return RATE_LIMITED
+    if failure == FAILURE_CONNECTION:
+        return CONNECTION
+    code = data.get("smtp_code")
+    if isinstance(code, int):
+        if 500 <= code < 600:
+            return PERMANENT
+        if 400 <= code < 500:
+            return TRANSIENT
+        if code < 0:  # smtplib reports -1 when the relay dropped the session
+            return CONNECTION
+    return UNKNOWN
+
+
+def exponential(base, level, cap):
+    return min(cap, base * (2 ** max(0, level)))
+
+
+class RetryPolicy:
+    """Decide whether a failed job is retried, and when, or moved to the dead letter queue.
+
+    The delay is the largest of three backoffs:
+
+    * per class: exponential in the job's retry count, with the class's
+      base and cap;
+    * per destination domain (transient failures): exponential in the number
+      of failures seen for that domain within ``failure_window``, so a domain
+      that keeps deferring pushes all of its retries out together. The
+      worker scheduler's own ``domain_backoff`` is honoured as well;
+    * per class outage (connection failures): exponential in the number of
+      connection failures within ``outage_window``, so a relay outage does not
+      turn into a resend storm.
+    """
+
+    def __init__(self, r, policy, jitter=0.1):
+        self.r = r
+        self.policy = policy
+        self.jitter = jitter
+
+    def class_settings(self, klass):
+        return self.policy["classes"].get(klass, self.policy["classes"][UNKNOWN])
+
+    def domain_settings(self, domain):
+        return {**self.policy["domains"]["default"], **self.policy["domains"].get(domain, {})}
+
+    def failure_streak(self, key, window):
+        """Failures counted under key in the current fixed window."""
+        count = self.r.incr(key)
+        if count == 1:
+            self.r.expire(key, int(window))
+        return count
+
+    def domain_delay(self, domain):
+        settings = self.domain_settings(domain)
+        streak = self.failure_streak(f"retry_domain_failures:{domain}", settings["failure_window"])
+        delay = exponential(settings["base_delay"], streak - 1, settings["max_delay"])
+        backoff_ms = self.r.pttl(f"domain_backoff:{domain}")
+        return max(delay, backoff_ms / 1000.0 if backoff_ms and backoff_ms > 0 else 0)
+
+    def outage_delay(self, klass, settings):
+        if "outage_window" not in settings:
+            return 0
+        streak = self.failure_streak(f"retry_class_failures:{klass}", settings["outage_window"])
+        # Grow with the log of the streak: hundreds of jobs failing at once share one backoff level
+        return exponential(settings["outage_base_delay"], streak.bit_length() - 1, settings["max_delay"])
+
+    def rate_limit_delay(self, data):
+        ttl = self.r.ttl(f"rate_limit:{data.get('from')}")
+        return ttl if ttl and ttl > 0 else 0
+
+    def decide(self, data):
+        """Return (action, delay seconds, failure class) for a job taken from failed_jobs."""
+        klass = classify(data)
+        settings = self.class_settings(klass)
+        retries = data.get("retries", 0)
+        if retries >= settings.get("max_retries", 0):
+            return DEAD_LETTER, 0, klass
+
+        delay = exponential(settings["base_delay"], retries, settings["max_delay"])
+        if klass == TRANSIENT:
+            delay = max(delay, self.domain_delay(recipient_domain(data)))
+        elif klass == RATE_LIMITED:
+            delay = max(delay, self.rate_limit_delay(data))
+        delay = max(delay, self.outage_delay(klass, settings))
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return RETRY, delay, klass
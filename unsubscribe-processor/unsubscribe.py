@@ -1,28 +1,15 @@
 import redis
 import json
 import time
-import logging
-import os
-from pythonjsonlogger import jsonlogger
 from os import getenv
 from email_validator import validate_email, EmailNotValidError
+from common.lanes import LANE_NAMES, WeightedLaneScheduler, lane_key
+from common.job_codec import decode_job, encode_job
+from common.logs import job_logger, setup_logging
 
-# Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"unsubscribe_{time.strftime('%Y%m%d')}.log")
-logger = logging.getLogger(__name__)
-logger.setLevel(getenv("LOG_LEVEL", "INFO"))
-formatter = jsonlogger.JsonFormatter(
-    fmt="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Configure logging (background writer; per-job INFO lines are rate limited)
+logger = setup_logging(__name__, "unsubscribe")
+job_log = job_logger(logger)
 
 def load_initial_unsub_list(r, unsub_file, unsub_set_key):
     """Load initial unsubscribe list from file to Redis."""
@@ -44,13 +31,18 @@ def load_initial_unsub_list(r, unsub_file, unsub_set_key):
     except Exception as e:
         logger.error(f"Failed to load unsubscribe file: {e}")
 
-def process_complaints(r, complaint_queue, unsub_set_key):
-    """Process complaints from bounced queue to auto-unsubscribe."""
+def process_complaints(r, q, complaint_queue, unsub_set_key):
+    """Process a complaint from the bounced queue to auto-unsubscribe.
+
+    Never blocks: it runs once per job, and waiting here would cap job
+    filtering at one job per second. When idle, the job pop's own timeout
+    paces the loop.
+    """
     try:
-        job = r.brpop(complaint_queue, timeout=1)
-        if not job:
+        raw = q.rpop(complaint_queue)
+        if raw is None:
             return
-        data = json.loads(job[1])
+        data = decode_job(raw)
         smtp_code = data.get("smtp_code", 0)
         email = data.get("to")
         if smtp_code >= 500:  # Permanent failure
@@ -80,6 +72,10 @@ def main():
         blpop_timeout = int(getenv("BLPOP_TIMEOUT", "5"))
 
         r = redis.Redis.from_url(redis_url, decode_responses=True)
+        # Binary client for job payloads (msgpack); r stays for counters and sets
+        q = redis.Redis.from_url(redis_url)
+        lane_queues = {lane: lane_key(job_queue, lane) for lane in LANE_NAMES}
+        lane_scheduler = WeightedLaneScheduler()
         logger.info("Unsubscribe processor started")
 
         # Load initial unsubscribe list
@@ -88,22 +84,23 @@ def main():
         while True:
             try:
                 # Process complaints periodically
-                process_complaints(r, complaint_queue, unsub_set_key)
+                process_complaints(r, q, complaint_queue, unsub_set_key)
 
-                # Process email jobs
-                job = r.blpop(job_queue, timeout=blpop_timeout)
+                # Process email jobs, weighted fair across priority lanes
+                job = lane_scheduler.pop(q, lane_queues, blpop_timeout, legacy_queue=job_queue)
                 if not job:
                     continue
 
+                lane, raw = job
                 try:
-                    data = json.loads(job[1])
-                except json.JSONDecodeError as e:
-                    logger.error(f"Invalid JSON in job: {job[1]}, error: {e}")
+                    data = decode_job(raw)
+                except ValueError as e:
+                    logger.error(f"Undecodable job: {raw!r}, error: {e}")
                     r.incr("unsubscribe_metrics:json_errors")
                     continue
 
                 job_id = data.get("job_id", "unknown")
-                logger.debug(f"Processing job {job_id}")
+                job_log.debug(f"Processing job {job_id}")
 
                 # Validate job data
                 if "to" not in data:
@@ -120,7 +117,7 @@ def main():
                         if not r.sismember(unsub_set_key, email):
                             valid_recipients.append(email)
                         else:
-                            logger.info(f"Skipped unsubscribed recipient: {email}")
+                            job_log.info(f"Skipped unsubscribed recipient: {email}")
                             r.incr("unsubscribe_metrics:skipped")
                     except EmailNotValidError:
                         logger.error(f"Invalid email in job: {email}")
@@ -128,11 +125,11 @@ def main():
 
                 if valid_recipients:
                     data["to"] = valid_recipients if len(valid_recipients) > 1 else valid_recipients[0]
-                    r.rpush(filtered_queue, json.dumps(data))
-                    logger.info(f"Job {job_id} forwarded to {filtered_queue}")
+                    r.rpush(lane_key(filtered_queue, lane), encode_job(data))
+                    job_log.info(f"Job {job_id} forwarded to {lane_key(filtered_queue, lane)}")
                     r.incr("unsubscribe_metrics:processed")
                 else:
-                    logger.info(f"Job {job_id} skipped: all recipients unsubscribed")
+                    job_log.info(f"Job {job_id} skipped: all recipients unsubscribed")
                     r.incr("unsubscribe_metrics:skipped_jobs")
 
             except redis.RedisError as e:
@@ -0,0 +1,67 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import logging
+from collections import Counter
+
+logger = logging.getLogger("worker.profiler")  # Child of the worker logger set up by setup_logging
+
+
+class SamplingProfiler:
+    """Stack-sampling profiler triggered by a signal.
+
+    On ``SIGUSR1`` a background thread samples the stack of the worker's main
+    thread every ``interval`` seconds for ``duration`` seconds, then writes the
+    samples in collapsed-stack format (one ``frame;frame;frame count`` line
+    per distinct stack), ready for flamegraph.pl or speedscope. Sampling only
+    reads frames, so the hot path keeps running at full speed in between.
+    """
+
+    def __init__(self, output_dir, duration=30, interval=0.005):
+        self.output_dir = output_dir
+        self.duration = duration
+        self.interval = interval
+        self.target_thread = threading.main_thread().ident
+        self._running = threading.Lock()
+
+    def install(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self._on_signal)
+        logger.info(f"Sampling profiler armed: send signal {signum} to pid {os.getpid()} to profile {self.duration}s")
+
+    def _on_signal(self, signum, frame):
+        if not self._running.acquire(blocking=False):
+            logger.warning("Profile already in progress, ignoring signal")
+            return
+        threading.Thread(target=self._run, name="sampling-profiler", daemon=True).start()
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def _run(self):
+        try:
+            samples = Counter()
+            deadline = time.monotonic() + self.duration
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.target_thread)
+                if frame is not None:
+                    samples[self._collapse(frame)] += 1
+                time.sleep(self.interval)
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f"worker_{socket.gethostname()}_{os.getpid()}_{time.strftime('%Y%m%d_%H%M%S')}.folded")
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"Wrote profile with {sum(samples.values())} samples to {path}")
+        except Exception as e:
+            logger.error(f"Profiling failed: {e}")
+        finally:
+            self._running.release()
@@ -0,0 +1,208 @@
+import json
+import random
+import time
+import logging
+import uuid
+from common.job_codec import as_text, decode_job
+from common.jobs import recipient_domain
+
+logger = logging.getLogger("worker.scheduler")  # Child of the worker logger set up by setup_logging
+
+# Atomically pop the next job of a domain shard, dropping the domain from the
+# ready set when the shard is empty. Doing both in one step keeps a concurrent
+# ingest (RPUSH + ZADD NX) from leaving a non-empty shard without a ready entry.
+POP_OR_RETIRE = """
+local job = redis.call('LPOP', KEYS[1])
+if not job then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return job
+"""
+
+# Move a batch of jobs from a lane queue into their domain shards in one step.
+# ARGV[2..] are the jobs peeked from the head of the queue; each is moved only
+# while it is still at the head, so a job another worker took first is never
+# duplicated and a crash can never leave a job outside both lists.
+# KEYS: queue, ready set, then one shard key per job; ARGV: now, jobs.., domains..
+INGEST_BATCH = """
+local n = (#ARGV - 1) / 2
+for i = 1, n do
+    local job = ARGV[i + 1]
+    if redis.call('LINDEX', KEYS[1], 0) ~= job then
+        return i - 1
+    end
+    redis.call('LPOP', KEYS[1])
+    redis.call('RPUSH', KEYS[i + 2], job)
+    redis.call('ZADD', KEYS[2], 'NX', ARGV[1], ARGV[n + i + 1])
+end
+return n
+"""
+
+
+def load_domain_limits(limits_file):
+    """Load per-domain concurrency/rate limits, keyed by domain with a 'default' entry."""
+    limits = {"default": {"concurrency": 5, "rate_per_sec": 10}}
+    try:
+        with open(limits_file) as f:
+            limits.update(json.load(f))
+    except FileNotFoundError:
+        logger.warning(f"Domain limits file {limits_file} not found, using defaults")
+    return limits
+
+
+class DomainScheduler:
+    """Shard pending jobs by priority lane and recipient domain and hand out work domain by domain.
+
+    Every lane/domain pair has its own Redis list
+    (``domain_queue:<lane>:<domain>``). Domains with pending work in a lane sit
+    in that lane's ``domain_ready:<lane>`` sorted set, scored by the time they
+    may next be served, so the lowest score is always the domain that has
+    waited longest. Per-domain in-flight holders, one-second rate windows and
+    backoff are shared by all lanes and kept in Redis, so limits hold across
+    all worker replicas. A 4xx deferral backs the domain off exponentially;
+    a success steps the backoff level back down.
+
+    In-flight sends are held in ``domain_inflight:<domain>``, a sorted set of
+    holder tokens scored by acquire time. Holders older than ``hold_timeout``
+    (left by crashed workers) are pruned on every acquire, so a leaked slot
+    is recovered even while the domain keeps getting traffic.
+    """
+
+    def __init__(self, r, limits, lanes=("normal",), backoff_base=30, backoff_max=900, scan_size=20,
+                 hold_timeout=300):
+        self.r = r
+        self.limits = limits
+        self.lanes = list(lanes)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.scan_size = scan_size
+        self.hold_timeout = hold_timeout
+        self._held = {}  # domain -> holder tokens taken by this scheduler
+        self._pop = r.register_script(POP_OR_RETIRE)
+        self._ingest_batch = r.register_script(INGEST_BATCH)
+
+    @staticmethod
+    def ready_key(lane):
+        return f"domain_ready:{lane}"
+
+    @staticmethod
+    def shard_key(lane, domain):
+        return f"domain_queue:{lane}:{domain}"
+
+    def _limit(self, domain, name):
+        return self.limits.get(domain, {}).get(name, self.limits["default"][name])
+
+    @staticmethod
+    def job_domain(raw):
+        try:
+            return recipient_domain(decode_job(raw))
+        except (ValueError, AttributeError):
+            return "unknown"
+
+    def ingest_from(self, queue, lane, count=100):
+        """Drain up to ``count`` jobs from a FIFO lane queue into domain shards.
+
+        The head of the queue is read first to find each job's domain, then
+        moved atomically by INGEST_BATCH: two round trips per batch, and jobs
+        are never held only in this process.
+        """
+        raws = self.r.lrange(queue, 0, count - 1)
+        if not raws:
+            return 0
+        domains = [self.job_domain(raw) for raw in raws]
+        return self._ingest_batch(
+            keys=[queue, self.ready_key(lane)] + [self.shard_key(lane, domain) for domain in domains],
+            args=[time.time()] + raws + domains,
+        )
+
+    def ready_lanes(self):
+        """Lanes that have at least one domain whose turn has come."""
+        now = time.time()
+        pipe = self.r.pipeline()
+        for lane in self.lanes:
+            pipe.zcount(self.ready_key(lane), "-inf", now)
+        return {lane for lane, ready in zip(self.lanes, pipe.execute()) if ready}
+
+    def _acquire(self, lane, domain):
+        inflight_key = f"domain_inflight:{domain}"
+        token = uuid.uuid4().hex
+        now = time.time()
+        pipe = self.r.pipeline()
+        pipe.pttl(f"domain_backoff:{domain}")
+        pipe.zremrangebyscore(inflight_key, "-inf", now - self.hold_timeout)  # Slots held by crashed workers
+        pipe.zadd(inflight_key, {token: now})
+        pipe.zcard(inflight_key)
+        pipe.expire(inflight_key, int(self.hold_timeout))
+        backoff_ms, _, _, inflight, _ = pipe.execute()
+        if backoff_ms > 0:
+            # Backed off from another lane: skip until the backoff expires
+            self.r.zrem(inflight_key, token)
+            self.r.zadd(self.ready_key(lane), {domain: time.time() + backoff_ms / 1000}, xx=True)
+            return False
+        if inflight > self._limit(domain, "concurrency"):
+            self.r.zrem(inflight_key, token)
+            return False
+        rate_key = f"domain_rate:{domain}:{int(time.time())}"
+        pipe = self.r.pipeline()
+        pipe.incr(rate_key)
+        pipe.expire(rate_key, 2)
+        sent, _ = pipe.execute()
+        if sent > self._limit(domain, "rate_per_sec"):
+            self.r.zrem(inflight_key, token)
+            # Skip the domain until the next one-second window
+            self.r.zadd(self.ready_key(lane), {domain: int(time.time()) + 1}, xx=True)
+            return False
+        self._held.setdefault(domain, []).append(token)
+        return True
+
+    def next_job(self, lane):
+        """Return (domain, raw_job) for the next sendable job in a lane, or None."""
+        now = time.time()
+        ready_key = self.ready_key(lane)
+        for domain in map(as_text, self.r.zrangebyscore(ready_key, "-inf", now, start=0, num=self.scan_size)):
+            if not self._acquire(lane, domain):
+                continue
+            raw = self._pop(keys=[self.shard_key(lane, domain), ready_key], args=[domain])
+            if raw is None:
+                self.release(domain)
+                continue
+            # Re-score to now so other ready domains are served first (round robin)
+            self.r.zadd(ready_key, {domain: now}, xx=True)
+            return domain, raw
+        return None
+
+    def seconds_until_ready(self, default):
+        """Seconds until the earliest backed-off domain becomes ready, capped at ``default``."""
+        pipe = self.r.pipeline()
+        for lane in self.lanes:
+            pipe.zrange(self.ready_key(lane), 0, 0, withscores=True)
+        heads = [head[0][1] for head in pipe.execute() if head]
+        if not heads:
+            return default
+        return max(0.1, min(default, min(heads) - time.time()))
+
+    def release(self, domain):
+        """Free the in-flight slot taken by next_job."""
+        tokens = self._held.get(domain)
+        if tokens:
+            self.r.zrem(f"domain_inflight:{domain}", tokens.pop())
+
+    def record_success(self, domain):
+        level_key = f"domain_backoff_level:{domain}"
+        if self.r.exists(level_key) and self.r.decr(level_key) <= 0:
+            self.r.delete(level_key)
+
+    def defer(self, domain, raw, lane):
+        """Requeue a deferred job and back the whole domain off in every lane."""
+        level_key = f"domain_backoff_level:{domain}"
+        level = self.r.incr(level_key)
+        self.r.expire(level_key, int(self.backoff_max * 4))
+        delay = min(self.backoff_base * (2 ** (level - 1)), self.backoff_max)
+        delay *= random.uniform(0.8, 1.2)  # Jitter so replicas don't retry in lockstep
+        pipe = self.r.pipeline()
+        pipe.set(f"domain_backoff:{domain}", level, px=int(delay * 1000))
+        pipe.rpush(self.shard_key(lane, domain), raw)
+        pipe.zadd(self.ready_key(lane), {domain: time.time() + delay})
+        pipe.execute()
+        logger.warning(f"Domain {domain} deferred, backing off {delay:.0f}s (level {level})")
+        return delay
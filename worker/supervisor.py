@@ -0,0 +1,316 @@
+"""Pre-forked worker supervisor: runs WORKER_MIN..WORKER_MAX worker processes per container.
+
+The parent loads the SMTP relay list, DKIM key and domain limits once and
+forks the workers, which share them copy-on-write. Every
+SCALE_INTERVAL_SECONDS it sizes the pool from the pending queue depth and the
+measured per-process throughput, and it restarts workers that crash.
+Worker metrics are aggregated through prometheus_client multiprocess mode
+and served by the parent on METRICS_PORT.
+"""
+import os
+import shutil
+import tempfile
+
+# prometheus_client picks its value storage when first imported, so the
+# multiprocess directory must be ready before worker is imported. Stale files
+# from an earlier run would be summed into the live metrics.
+OWN_METRICS_DIR = not os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if OWN_METRICS_DIR:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="worker_metrics_")
+else:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    for stale in os.listdir(os.environ["PROMETHEUS_MULTIPROC_DIR"]):
+        os.remove(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], stale))
+
+import gc
+import math
+import signal
+import socket
+import time
+from multiprocessing.sharedctypes import RawArray
+from os import getenv
+import redis
+from prometheus_client import CollectorRegistry, Counter, Gauge, multiprocess, start_http_server
+import worker
+from scheduler import DomainScheduler
+from common.lanes import LANE_NAMES, lane_key
+from common.logs import after_fork, setup_logging, shutdown_logging
+
+logger = setup_logging("supervisor", "worker_supervisor")
+
+PROCESSES = Gauge("worker_supervisor_processes", "Worker processes the supervisor is aiming for",
+                  multiprocess_mode="max")
+RUNNING = Gauge("worker_supervisor_running_processes", "Worker processes currently alive",
+                multiprocess_mode="max")
+QUEUE_DEPTH = Gauge("worker_supervisor_queue_depth", "Pending jobs seen at the last scaling decision",
+                    multiprocess_mode="max")
+PROCESS_THROUGHPUT = Gauge("worker_supervisor_process_throughput", "Measured jobs/s per busy worker process",
+                           multiprocess_mode="max")
+RESTARTS = Counter("worker_supervisor_restarts", "Worker processes restarted after exiting unexpectedly")
+
+
+class WorkerSupervisor:
+    """Fork, scale and restart worker processes.
+
+    Each child owns a slot; a shared-memory counter per slot tells the parent
+    how many jobs it has processed, which gives the per-process throughput
+    used for scaling without any extra Redis traffic from the workers.
+    """
+
+    def __init__(self, r, shared, min_procs, max_procs, job_queue, interval=15, drain_seconds=60,
+                 restart_backoff_max=30, heartbeat_key="worker_supervisors"):
+        self.r = r
+        self.shared = shared
+        self.min_procs = min_procs
+        self.max_procs = max_procs
+        self.job_queue = job_queue
+        self.interval = interval
+        self.drain_seconds = drain_seconds
+        self.restart_backoff_max = restart_backoff_max
+        self.heartbeat_key = heartbeat_key
+        self.name = socket.gethostname()
+        self.target = min_procs
+        self.processed = RawArray("Q", max_procs)
+        self.slots = {}  # slot -> pid
+        self.started = {}  # pid -> (slot, start time)
+        self.retiring = set()
+        self.quick_exits = {}  # slot -> consecutive exits shortly after start
+        self.restart_at = {}  # slot -> earliest restart time
+        self.per_process_rate = 0.0
+        self.last_total = 0
+        self.last_check = time.monotonic()
+        self.last_depth = 0
+        self.stopping = False
+
+    def spawn(self, slot):
+        # Freeze the inherited heap so the child's garbage collector does not touch (and copy) it
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            self.run_child(slot)
+        self.slots[slot] = pid
+        self.started[pid] = (slot, time.monotonic())
+        logger.info(f"Started worker process {pid} in slot {slot}")
+
+    def run_child(self, slot):
+        """Body of a forked worker process; never returns."""
+        code = 0
+        try:
+            stop = []
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # Ignored unless run_worker arms the profiler; never the parent's forwarding handler
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            after_fork(file_suffix=slot)
+            processed = self.processed
+
+            def on_job():
+                processed[slot] += 1
+
+            worker.run_worker(self.shared, should_stop=lambda: bool(stop), on_job=on_job)
+        except Exception as e:
+            worker.logger.critical(f"Worker process crashed: {e}")
+            code = 1
+        finally:
+            shutdown_logging()
+            os._exit(code)
+
+    def reap(self):
+        """Collect exited children and schedule restarts for those that were not asked to stop."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            multiprocess.mark_process_dead(pid)
+            slot, started = self.started.pop(pid)
+            if self.slots.get(slot) == pid:
+                del self.slots[slot]
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info(f"Worker process {pid} in slot {slot} stopped")
+                continue
+            lived = time.monotonic() - started
+            # Back off exponentially when a slot keeps dying right after start (bad config, Redis down)
+            self.quick_exits[slot] = self.quick_exits.get(slot, 0) + 1 if lived < 30 else 0
+            delay = min(self.restart_backoff_max, 2 ** self.quick_exits[slot] - 1)
+            self.restart_at[slot] = time.monotonic() + delay
+            logger.error(f"Worker process {pid} in slot {slot} exited with status "
+                         f"{os.waitstatus_to_exitcode(status)} after {lived:.0f}s, restarting in {delay}s")
+            RESTARTS.inc()
+            try:
+                self.r.incr("worker_metrics:process_restarts")
+            except redis.RedisError:
+                pass
+
+    def reconcile(self):
+        """Start processes for empty slots below the target and retire those above it."""
+        if self.stopping:
+            return
+        now = time.monotonic()
+        for slot in range(self.target):
+            if slot not in self.slots and now >= self.restart_at.get(slot, 0):
+                self.spawn(slot)
+        for slot, pid in self.slots.items():
+            if slot >= self.target and pid not in self.retiring:
+                logger.info(f"Scaling down: stopping worker process {pid} in slot {slot}")
+                os.kill(pid, signal.SIGTERM)
+                self.retiring.add(pid)
+        RUNNING.set(len(self.slots))
+
+    def queue_depth(self):
+        """Jobs waiting in the lanes plus those sharded to domains that may be served now.
+
+        The plain pre-lane list counts too, until workers have drained it.
+        Domains in backoff or over their rate limit are scored in the future;
+        more processes cannot send their jobs any sooner, so they are left out.
+        """
+        now = time.time()
+        pipe = self.r.pipeline()
+        for lane in LANE_NAMES:
+            pipe.llen(lane_key(self.job_queue, lane))
+            pipe.zrangebyscore(DomainScheduler.ready_key(lane), "-inf", now)
+        pipe.llen(self.job_queue)
+        results = pipe.execute()
+        depth = sum(results[0:-1:2]) + results[-1]
+        pipe = self.r.pipeline()
+        for lane, domains in zip(LANE_NAMES, results[1:-1:2]):
+            for domain in domains:
+                pipe.llen(DomainScheduler.shard_key(lane, domain))
+        return depth + sum(pipe.execute())
+
+    def supervisors(self):
+        """Live supervisors sharing the queue (one per container), this one included."""
+        now = time.time()
+        pipe = self.r.pipeline()
+        pipe.zadd(self.heartbeat_key, {self.name: now})
+        pipe.zremrangebyscore(self.heartbeat_key, "-inf", now - 3 * self.interval)
+        pipe.zcard(self.heartbeat_key)
+        return max(1, pipe.execute()[-1])
+
+    def autoscale(self):
+        """Size the pool so this container's share of the backlog drains within drain_seconds."""
+        now = time.monotonic()
+        total = sum(self.processed)
+        busy = len([pid for pid in self.slots.values() if pid not in self.retiring])
+        rate = (total - self.last_total) / max(now - self.last_check, 1e-6)
+        # Only intervals that started with a backlog measure what a process can do
+        if self.last_depth > 0 and busy and rate > 0:
+            self.per_process_rate = rate / busy if not self.per_process_rate \
+                else 0.5 * self.per_process_rate + 0.5 * rate / busy
+        self.last_total, self.last_check = total, now
+
+        try:
+            depth = self.queue_depth()
+            supervisors = self.supervisors()
+        except redis.RedisError as e:
+            logger.error(f"Redis error while scaling, keeping {self.target} processes: {e}")
+            return
+        self.last_depth = depth
+
+        if depth == 0:
+            desired = self.min_procs
+        elif self.per_process_rate > 0:
+            desired = math.ceil(depth / (self.per_process_rate * self.drain_seconds) / supervisors)
+        else:
+            desired = self.target + 1  # no throughput measured yet: grow one step at a time
+        desired = max(self.min_procs, min(self.max_procs, desired))
+
+        if desired > self.target:
+            logger.info(f"Scaling up to {desired} processes: depth {depth}, "
+                        f"{self.per_process_rate:.1f} jobs/s per process, {supervisors} supervisor(s)")
+            self.target = desired
+        elif desired < self.target:
+            # Shrink one process per interval so a brief lull does not drop the whole pool
+            self.target -= 1
+            logger.info(f"Scaling down to {self.target} processes: depth {depth}")
+        PROCESSES.set(self.target)
+        QUEUE_DEPTH.set(depth)
+        PROCESS_THROUGHPUT.set(self.per_process_rate)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def forward(self, signum, frame):
+        """Pass a signal sent to the supervisor (PID 1 in the container) on to every worker process.
+
+        This keeps ``docker kill -s USR1`` able to trigger the workers' sampling profiler.
+        """
+        sent = 0
+        for pid in self.slots.values():
+            if pid not in self.retiring:
+                try:
+                    os.kill(pid, signum)
+                    sent += 1
+                except ProcessLookupError:
+                    pass
+        logger.info(f"Forwarded signal {signum} to {sent} worker processes")
+
+    def shutdown(self, grace):
+        """Ask every worker to finish its current job, then kill whatever is left after grace seconds."""
+        for pid in self.slots.values():
+            os.kill(pid, signal.SIGTERM)
+            self.retiring.add(pid)
+        deadline = time.monotonic() + grace
+        while self.slots and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.2)
+        for pid in list(self.slots.values()):
+            logger.warning(f"Worker process {pid} did not stop within {grace}s, killing it")
+            os.kill(pid, signal.SIGKILL)
+        while self.slots:
+            self.reap()
+            time.sleep(0.1)
+        try:
+            self.r.zrem(self.heartbeat_key, self.name)
+        except redis.RedisError:
+            pass
+
+    def run(self, grace=30):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.forward)
+        logger.info(f"Supervisor started: {self.min_procs}-{self.max_procs} worker processes")
+        next_scale = time.monotonic()
+        while not self.stopping:
+            self.reap()
+            if time.monotonic() >= next_scale:
+                self.autoscale()
+                next_scale = time.monotonic() + self.interval
+            self.reconcile()
+            time.sleep(1)
+        logger.info("Supervisor stopping")
+        self.shutdown(grace)
+
+
+def main():
+    try:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(int(getenv("METRICS_PORT", "8000")), registry=registry)
+
+        min_procs = int(getenv("WORKER_MIN_PROCESSES", "1"))
+        max_procs = max(min_procs, int(getenv("WORKER_MAX_PROCESSES", "8")))
+        supervisor = WorkerSupervisor(
+            redis.Redis.from_url(getenv("QUEUE_URL", "redis://queue:6379/0"), decode_responses=True),
+            worker.load_shared_state(),
+            min_procs,
+            max_procs,
+            getenv("JOB_QUEUE", "email_jobs"),
+            interval=float(getenv("SCALE_INTERVAL_SECONDS", "15")),
+            drain_seconds=float(getenv("SCALE_TARGET_DRAIN_SECONDS", "60")),
+            restart_backoff_max=float(getenv("RESTART_BACKOFF_MAX_SECONDS", "30")),
+        )
+        supervisor.run(grace=float(getenv("SHUTDOWN_GRACE_SECONDS", "30")))
+    except Exception as e:
+        logger.critical(f"Fatal error: {e}")
+        raise
+    finally:
+        if OWN_METRICS_DIR:
+            shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
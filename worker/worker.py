@@ -2,31 +2,47 @@ import redis
 import json
 import time
 import smtplib
-import logging
+import socket
 import os
 import random
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from pythonjsonlogger import jsonlogger
 from os import getenv
 import dkim
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from scheduler import DomainScheduler, load_domain_limits
+from common.lanes import LANE_NAMES, WeightedLaneScheduler, consumer_queues
+from common.body_store import BodyNotFound, CachedBodyStore, job_body, make_body_store
+from common.job_codec import decode_job, encode_job
+from common.logs import job_logger, log_stats, setup_logging
+from common.jobs import (FAILURE_CONNECTION, FAILURE_ERROR, FAILURE_INVALID, FAILURE_MISSING_BODY,
+                         FAILURE_RATE_LIMITED, FAILURE_SMTP, mark_failed)
+from profiler import SamplingProfiler
 
-# Configure logging
-log_dir = "/app/logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"worker_{time.strftime('%Y%m%d')}.log")
-logger = logging.getLogger(__name__)
-logger.setLevel(getenv("LOG_LEVEL", "INFO"))
-formatter = jsonlogger.JsonFormatter(
-    fmt="%(asctime)s %(levelname)s %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler = logging.FileHandler(log_file)
-file_handler.setFormatter(formatter)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+# Configure logging (background writer; per-job INFO lines are rate limited)
+logger = setup_logging("worker", "worker")
+job_log = job_logger(logger)
+
+# Prometheus metrics
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+QUEUE_WAIT = Histogram("worker_queue_wait_seconds", "Time from gateway submission to first delivery attempt",
+                       ["lane"], buckets=WAIT_BUCKETS)
+END_TO_END = Histogram("worker_end_to_end_seconds", "Time from gateway submission to successful delivery",
+                       ["lane", "relay"], buckets=WAIT_BUCKETS)
+STAGE_LATENCY = Histogram("worker_stage_seconds", "Time spent in each delivery stage",
+                          ["stage", "relay"], buckets=STAGE_BUCKETS)
+JOB_OUTCOMES = Counter("worker_jobs_total", "Jobs processed by outcome", ["outcome", "relay"])
+# Set from a thread rather than set_function so the values survive prometheus multiprocess mode (supervisor.py)
+LOG_RECORDS_LOST = Gauge("worker_log_records_lost", "Log records not written: dropped (writer queue full) "
+                         "or suppressed (per-job rate limit/sampling)", ["reason"], multiprocess_mode="livesum")
+
+def observe_stage(stage, relay, started):
+    """Record the time since ``started`` for a delivery stage and return a new start mark."""
+    now = time.perf_counter()
+    STAGE_LATENCY.labels(stage=stage, relay=relay).observe(now - started)
+    return now
 
 def load_smtp_configs(config_file, secrets_path="/run/secrets"):
     """Load SMTP configurations and credentials from secrets."""
@@ -61,12 +77,21 @@ def select_smtp_config(configs, r):
     weights = [w / total_weight for _, w in valid_configs]
     return random.choices([c for c, _ in valid_configs], weights=weights)[0]
 
-def sign_dkim(msg, domain, selector, private_key_path):
+def load_dkim_key(private_key_path):
+    """Read the DKIM private key once; None (messages go out unsigned) when it cannot be read."""
+    try:
+        with open(private_key_path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        logger.error(f"Failed to load DKIM key {private_key_path}, messages will not be signed: {e}")
+        return None
+
+def sign_dkim(msg, domain, selector, private_key):
     """Sign email with DKIM."""
+    if private_key is None:
+        return
     try:
         headers = [b"To", b"From", b"Subject"]
-        with open(private_key_path, "rb") as f:
-            private_key = f.read()
         sig = dkim.sign(
             message=msg.as_string().encode(),
             selector=selector.encode(),
@@ -79,100 +104,260 @@ def sign_dkim(msg, domain, selector, private_key_path):
     except Exception as e:
         logger.error(f"DKIM signing failed: {e}")
 
-def main():
+def build_message(data, body):
+    """Build the MIME message for a job."""
+    msg = MIMEMultipart()
+    msg["From"] = data["from"]
+    msg["To"] = ", ".join(data["to"] if isinstance(data["to"], list) else [data["to"]])
+    msg["Subject"] = data["subject"]
+    msg.attach(MIMEText(body, "plain"))
+    return msg
+
+def send_email(data, smtp_conf, msg):
+    """Deliver a built message through the given SMTP relay, timing each SMTP stage."""
+    relay = smtp_conf.get("id", smtp_conf["host"])
+    started = time.perf_counter()
+    # Without a timeout a stalled relay would hold this worker forever
+    with smtplib.SMTP(smtp_conf["host"], smtp_conf["port"], timeout=smtp_conf.get("timeout", 30)) as smtp:
+        smtp.ehlo()
+        started = observe_stage("smtp_connect", relay, started)
+        if smtp_conf.get("user") and smtp_conf.get("pass"):
+            smtp.starttls()
+            started = observe_stage("tls", relay, started)
+            smtp.login(smtp_conf["user"], smtp_conf["pass"])
+            started = observe_stage("auth", relay, started)
+        smtp.sendmail(data["from"], data["to"], msg.as_string())
+        observe_stage("data", relay, started)
+
+def smtp_error_code(e):
+    """Return the SMTP reply code behind a failed send."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # Every recipient was refused; defer if any of them was only a 4xx
+        return min(code for code, _ in e.recipients.values())
+    return e.smtp_code
+
+def record_queue_wait(r, lane, data):
+    """Count how long a job waited before its first delivery attempt, per lane."""
+    if data.get("deferrals") or data.get("retries") or "submitted_at" not in data:
+        return
+    wait = max(0.0, time.time() - float(data["submitted_at"]))
+    QUEUE_WAIT.labels(lane=lane).observe(wait)
+    pipe = r.pipeline()
+    pipe.incrbyfloat(f"worker_metrics:queue_wait_seconds:{lane}", wait)
+    pipe.incr(f"worker_metrics:dequeued:{lane}")
+    pipe.execute()
+
+def process_job(r, scheduler, lane, domain, raw, settings, smtp_configs, body_store):
+    """Validate, send and route a single job taken from a domain shard."""
+    data = decode_job(raw)
+    job_id = data.get("job_id", "unknown")
+    job_log.info(f"Processing job {job_id}")
+    record_queue_wait(r, lane, data)
+
+    # Validate job data; the body travels inline or as a body store reference
+    required_fields = ["from", "to", "subject"]
+    if not all(field in data for field in required_fields) or not ("body" in data or "body_ref" in data):
+        logger.error(f"Invalid job data: {data}")
+        r.rpush(settings["failed_queue"], encode_job(mark_failed(data, FAILURE_INVALID)))
+        return
+
+    # Fetch the body without copying it back into the job, so queue copies stay small
     try:
-        # Configuration from environment variables
-        redis_url = getenv("QUEUE_URL", "redis://queue:6379/0")
-        job_queue = getenv("JOB_QUEUE", "email_jobs")
-        delivered_queue = getenv("DELIVERED_QUEUE", "delivered")
-        failed_queue = getenv("FAILED_QUEUE", "failed_jobs")
-        bounced_queue = getenv("BOUNCED_QUEUE", "bounced")
-        smtp_config_file = getenv("SMTP_CONFIG_FILE", "/app/smtp_rotation.json")
-        blpop_timeout = int(getenv("BLPOP_TIMEOUT", "5"))
-        dkim_key_path = getenv("DKIM_KEY_PATH", "/app/keys/yourdomain.com.mail.private")
-        dkim_domain = getenv("DKIM_DOMAIN", "yourdomain.com")
-        dkim_selector = getenv("DKIM_SELECTOR", "mail")
-
-        r = redis.Redis.from_url(redis_url, decode_responses=True)
-        smtp_configs = load_smtp_configs(smtp_config_file)
-        logger.info("Worker started")
-
-        while True:
+        body = job_body(body_store, data)
+    except BodyNotFound:
+        logger.error(f"Body {data.get('body_ref')} of job {job_id} not found in body store")
+        r.rpush(settings["failed_queue"], encode_job(mark_failed(data, FAILURE_MISSING_BODY)))
+        r.incr("worker_metrics:missing_bodies")
+        return
+    except OSError as e:
+        # Store unreadable (permissions, I/O): fail the job so the retry handler sees it
+        logger.error(f"Failed to read body {data.get('body_ref')} of job {job_id}: {e}")
+        r.rpush(settings["failed_queue"], encode_job(mark_failed(data, FAILURE_ERROR, str(e))))
+        r.incr("worker_metrics:unexpected_errors")
+        return
+
+    # Check rate limit
+    sender = data["from"]
+    rate_key = f"rate_limit:{sender}"
+    count = r.incr(rate_key)
+    if count == 1:
+        r.expire(rate_key, 3600)  # 1-hour window
+    if count > settings["sender_rate_limit"]:  # emails/hour
+        logger.warning(f"Rate limit exceeded for {sender}")
+        r.rpush(settings["failed_queue"], encode_job(mark_failed(data, FAILURE_RATE_LIMITED)))
+        return
+
+    relay = "none"
+    try:
+        # Select SMTP server
+        smtp_conf = select_smtp_config(smtp_configs, r)
+        relay = smtp_conf.get("id", smtp_conf["host"])
+        logger.debug(f"Selected SMTP: {smtp_conf['host']}:{smtp_conf['port']}")
+
+        started = time.perf_counter()
+        msg = build_message(data, body)
+        started = observe_stage("mime_build", relay, started)
+        sign_dkim(msg, settings["dkim_domain"], settings["dkim_selector"], settings["dkim_key"])
+        observe_stage("dkim_sign", relay, started)
+        send_email(data, smtp_conf, msg)
+
+        job_log.info(f"Job {job_id} delivered")
+        r.rpush(settings["delivered_queue"], encode_job(data))
+        r.incr("worker_metrics:deliveries")
+        scheduler.record_success(domain)
+        JOB_OUTCOMES.labels(outcome="delivered", relay=relay).inc()
+        if "submitted_at" in data:
+            END_TO_END.labels(lane=lane, relay=relay).observe(max(0.0, time.time() - float(data["submitted_at"])))
+
+    except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError,
+            socket.gaierror) as e:
+        # The relay itself is unreachable or hung up: nothing to learn about the destination domain
+        logger.error(f"Connection error for job {job_id} via {relay}: {e}")
+        r.rpush(settings["failed_queue"], encode_job(mark_failed(data, FAILURE_CONNECTION, str(e), relay=relay)))
+        r.incr("worker_metrics:connection_errors")
+        JOB_OUTCOMES.labels(outcome="connection_error", relay=relay).inc()
+    except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+        smtp_code = smtp_error_code(e)
+        if 400 <= smtp_code < 500 and data.get("deferrals", 0) < settings["max_deferrals"]:
+            # Transient deferral: keep the job with its domain and slow the domain down
+            data["deferrals"] = data.get("deferrals", 0) + 1
+            logger.warning(f"Job {job_id} deferred by {domain}: {e}")
+            scheduler.defer(domain, encode_job(data), lane)
+            r.incr("worker_metrics:deferrals")
+            JOB_OUTCOMES.labels(outcome="deferred", relay=relay).inc()
+            return
+        mark_failed(data, FAILURE_SMTP, str(e), smtp_code, relay)
+        logger.error(f"SMTP error for job {job_id}: {e}")
+        r.rpush(settings["failed_queue"], encode_job(data))
+        r.rpush(settings["bounced_queue"], encode_job(data))
+        r.incr("worker_metrics:smtp_errors")
+        JOB_OUTCOMES.labels(outcome="smtp_error", relay=relay).inc()
+        if smtp_code >= 500:  # Permanent failure
+            r.incr("worker_metrics:permanent_failures")
+    except redis.RedisError:
+        raise
+    except Exception as e:
+        mark_failed(data, FAILURE_ERROR, str(e), relay=relay)
+        logger.error(f"Unexpected error for job {job_id}: {e}")
+        r.rpush(settings["failed_queue"], encode_job(data))
+        r.rpush(settings["bounced_queue"], encode_job(data))
+        r.incr("worker_metrics:unexpected_errors")
+        JOB_OUTCOMES.labels(outcome="unexpected_error", relay=relay).inc()
+
+def export_log_stats(interval=15):
+    """Publish this process's lost log record counts to Prometheus."""
+    while True:
+        for reason, count in log_stats().items():
+            LOG_RECORDS_LOST.labels(reason=reason).set(count)
+        time.sleep(interval)
+
+def load_shared_state():
+    """Read-only state loaded once per container.
+
+    Under supervisor.py this is loaded before forking, so every worker
+    process shares the same SMTP relay list, DKIM key and domain limits
+    copy-on-write instead of reading them again.
+    """
+    return {
+        "smtp_configs": load_smtp_configs(getenv("SMTP_CONFIG_FILE", "/app/smtp_rotation.json")),
+        "dkim_key": load_dkim_key(getenv("DKIM_KEY_PATH", "/app/keys/yourdomain.com.mail.private")),
+        "domain_limits": load_domain_limits(getenv("DOMAIN_LIMITS_FILE", "/app/domain_limits.json")),
+    }
+
+def run_worker(shared, should_stop=lambda: False, on_job=None):
+    """Deliver jobs until should_stop() is true; on_job() is called after every processed job."""
+    # Configuration from environment variables
+    redis_url = getenv("QUEUE_URL", "redis://queue:6379/0")
+    job_queue = getenv("JOB_QUEUE", "email_jobs")
+    blpop_timeout = int(getenv("BLPOP_TIMEOUT", "5"))
+    ingest_batch = int(getenv("INGEST_BATCH", "100"))
+    settings = {
+        "delivered_queue": getenv("DELIVERED_QUEUE", "delivered"),
+        "failed_queue": getenv("FAILED_QUEUE", "failed_jobs"),
+        "bounced_queue": getenv("BOUNCED_QUEUE", "bounced"),
+        "dkim_key": shared["dkim_key"],
+        "dkim_domain": getenv("DKIM_DOMAIN", "yourdomain.com"),
+        "dkim_selector": getenv("DKIM_SELECTOR", "mail"),
+        "max_deferrals": int(getenv("DOMAIN_MAX_DEFERRALS", "5")),
+        "sender_rate_limit": int(getenv("SENDER_RATE_LIMIT_PER_HOUR", "100")),
+    }
+    smtp_configs = shared["smtp_configs"]
+
+    threading.Thread(target=export_log_stats, daemon=True).start()
+    if getenv("PROFILER_ENABLED", "false").lower() == "true":
+        SamplingProfiler(
+            getenv("PROFILE_DIR", os.path.join(getenv("LOG_DIR", "/app/logs"), "profiles")),
+            duration=float(getenv("PROFILE_SECONDS", "30")),
+            interval=float(getenv("PROFILE_INTERVAL_SECONDS", "0.005")),
+        ).install()
+
+    r = redis.Redis.from_url(redis_url, decode_responses=True)
+    # Binary client for job payloads (msgpack); r stays for counters and sets
+    q = redis.Redis.from_url(redis_url)
+    body_store = make_body_store(r)
+    if body_store:
+        body_store = CachedBodyStore(body_store, int(getenv("BODY_CACHE_SIZE", "1024")))
+    # Every lane plus the plain pre-lane list, read as the default lane
+    ingest_queues = consumer_queues(job_queue)
+    lane_scheduler = WeightedLaneScheduler()
+    scheduler = DomainScheduler(
+        q,
+        shared["domain_limits"],
+        lanes=LANE_NAMES,
+        backoff_base=float(getenv("DOMAIN_BACKOFF_BASE_SECONDS", "30")),
+        backoff_max=float(getenv("DOMAIN_BACKOFF_MAX_SECONDS", "900")),
+    )
+    logger.info("Worker started")
+
+    while not should_stop():
+        try:
+            # Shard newly queued jobs by lane and recipient domain
+            for lane, queue in ingest_queues:
+                scheduler.ingest_from(queue, lane, ingest_batch)
+
+            # Weighted fair pick of a lane; fall back to other ready lanes
+            # when every domain of the picked one is held back by its limits
+            picked = lane_scheduler.pick_from(scheduler.ready_lanes(), scheduler.next_job)
+
+            if not picked:
+                # Nothing sendable: wait for new jobs or the next domain to leave backoff
+                job = q.blmpop(
+                    scheduler.seconds_until_ready(blpop_timeout),
+                    len(ingest_queues),
+                    *[queue for _, queue in ingest_queues],
+                    direction="LEFT",
+                )
+                if job:
+                    # Only a wake-up: put the job back at the head, where the next
+                    # ingest_from moves it into its shard atomically
+                    key, raws = job
+                    q.lpush(key, *reversed(raws))
+                continue
+
+            lane, (domain, raw) = picked
             try:
-                job = r.blpop(job_queue, timeout=blpop_timeout)
-                if not job:
-                    continue
-
-                data = json.loads(job[1])
-                job_id = data.get("job_id", "unknown")
-                logger.info(f"Processing job {job_id}")
-
-                # Validate job data
-                required_fields = ["from", "to", "subject", "body"]
-                if not all(field in data for field in required_fields):
-                    logger.error(f"Invalid job data: {data}")
-                    r.rpush(failed_queue, json.dumps(data))
-                    continue
-
-                # Check rate limit
-                sender = data["from"]
-                rate_key = f"rate_limit:{sender}"
-                count = r.incr(rate_key)
-                if count == 1:
-                    r.expire(rate_key, 3600)  # 1-hour window
-                if count > 100:  # 100 emails/hour
-                    logger.warning(f"Rate limit exceeded for {sender}")
-                    r.rpush(failed_queue, json.dumps(data))
-                    continue
-
-                # Select SMTP server
-                smtp_conf = select_smtp_config(smtp_configs, r)
-                logger.debug(f"Selected SMTP: {smtp_conf['host']}:{smtp_conf['port']}")
-
-                # Build email
-                msg = MIMEMultipart()
-                msg["From"] = data["from"]
-                msg["To"] = ", ".join(data["to"] if isinstance(data["to"], list) else [data["to"]])
-                msg["Subject"] = data["subject"]
-                msg.attach(MIMEText(data["body"], "plain"))
-
-                # Sign DKIM
-                sign_dkim(msg, dkim_domain, dkim_selector, dkim_key_path)
-
-                # Send email
-                with smtplib.SMTP(smtp_conf["host"], smtp_conf["port"]) as smtp:
-                    smtp.ehlo()
-                    if smtp_conf.get("user") and smtp_conf.get("pass"):
-                        smtp.starttls()
-                        smtp.login(smtp_conf["user"], smtp_conf["pass"])
-                    smtp.sendmail(data["from"], data["to"], msg.as_string())
-                    logger.info(f"Job {job_id} delivered")
-                    r.rpush(delivered_queue, json.dumps(data))
-                    r.incr("worker_metrics:deliveries")
-
-            except smtplib.SMTPResponseException as e:
-                error_data = {"error": str(e), "smtp_code": e.smtp_code, **data}
-                data["retries"] = data.get("retries", 0) + 1
-                logger.error(f"SMTP error for job {job_id}: {e}")
-                r.rpush(failed_queue, json.dumps(data))
-                r.rpush(bounced_queue, json.dumps(error_data))
-                r.incr("worker_metrics:smtp_errors")
-                if e.smtp_code >= 500:  # Permanent failure
-                    r.incr("worker_metrics:permanent_failures")
-            except redis.RedisError as e:
-                logger.error(f"Redis error: {e}")
-                r.incr("worker_metrics:redis_errors")
-                time.sleep(5)
-            except Exception as e:
-                data["retries"] = data.get("retries", 0) + 1
-                logger.error(f"Unexpected error for job {job_id}: {e}")
-                r.rpush(failed_queue, json.dumps(data))
-                r.rpush(bounced_queue, json.dumps({"error": str(e), **data}))
-                r.incr("worker_metrics:unexpected_errors")
+                process_job(r, scheduler, lane, domain, raw, settings, smtp_configs, body_store)
+            finally:
+                scheduler.release(domain)
+                if on_job:
+                    on_job()
+
+        except redis.RedisError as e:
+            logger.error(f"Redis error: {e}")
+            r.incr("worker_metrics:redis_errors")
+            time.sleep(5)
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            r.incr("worker_metrics:unexpected_errors")
+    logger.info("Worker stopped")
 
+def main():
+    try:
+        start_http_server(int(getenv("METRICS_PORT", "8000")))
+        run_worker(load_shared_state())
     except Exception as e:
         logger.critical(f"Fatal error: {e}")
         raise
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()